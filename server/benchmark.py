@@ -0,0 +1,223 @@
+import argparse
+import time
+from typing import List, Optional
+
+import mlx.core as mx
+import mlx.nn as nn
+
+from .sampler import sample
+from .utils import batch_generate_step, generate_step, load, prefill
+
+
+def _decode(
+    model: nn.Module,
+    prompt: mx.array,
+    tokens: Optional[List[int]],
+    max_tokens: int,
+    kv_bits: Optional[int],
+    kv_group_size: int,
+):
+    """
+    Greedily decode `max_tokens` after `prompt`, or teacher-force `tokens`.
+
+    Returns the generated tokens, the per-step log probabilities, the
+    decode tokens per second and the final cache.
+    """
+    logits, cache = prefill(
+        model, prompt, kv_bits=kv_bits, kv_group_size=kv_group_size)
+    logits = logits[:, -1, :]
+    generated, logprobs = [], []
+    tic = time.perf_counter()
+    for n in range(max_tokens):
+        logprobs.append(logits - mx.logsumexp(logits, axis=-1, keepdims=True))
+        y = mx.argmax(logits, axis=-1)
+        generated.append(y.item())
+        y = y if tokens is None else mx.array([tokens[n]])
+        logits, cache = model(y[:, None], cache=cache)
+        logits = logits[:, -1, :]
+        mx.eval(logits)
+    toc = time.perf_counter()
+    return generated, mx.concatenate(logprobs, axis=0), max_tokens / (toc - tic), cache
+
+
+def kv_cache(args):
+    """
+    Compare KV cache precisions against the full precision cache.
+
+    The full precision greedy generation is the reference; each quantized
+    cache is teacher-forced along it and reports its memory per 1k
+    tokens, decode speed, top-1 agreement and mean KL divergence.
+    """
+    model, tokenizer = load(args.model)
+    prompt = mx.array(tokenizer.encode(args.prompt))
+
+    reference, ref_logprobs, _, _ = _decode(
+        model, prompt, None, args.max_tokens, None, args.kv_group_size)
+
+    print(f"{'kv_bits':>8} {'MB/1k tok':>10} {'tok/s':>8} {'top-1':>7} {'KL':>9}")
+    for bits in [None] + args.kv_bits:
+        generated, logprobs, tps, cache = _decode(
+            model, prompt, reference, args.max_tokens, bits, args.kv_group_size)
+        per_1k = sum(c.nbytes for c in cache) / cache[0].offset * 1000 / 2**20
+        agree = sum(a == b for a, b in zip(generated, reference)) / len(reference)
+        kl = mx.sum(mx.exp(ref_logprobs) * (ref_logprobs - logprobs), axis=-1)
+        name = "fp" if bits is None else str(bits)
+        print(f"{name:>8} {per_1k:>10.2f} {tps:>8.1f} {agree:>7.2%} {mx.mean(kl).item():>9.5f}")
+
+
+def decode(args):
+    """
+    Compare the decode speed of the eager and the compiled decode step, with
+    and without fused projections.
+    """
+    print(f"{'decode':>16} {'tok/s':>8}")
+    for fuse in (False, True):
+        model, tokenizer = load(args.model, fuse=fuse)
+        prompt = mx.array(tokenizer.encode(args.prompt))
+        for compiled in (False, True):
+            generator = generate_step(prompt, model, 0.0, compiled=compiled)
+            # the first tokens include the prefill and compilation
+            for (token, _), _ in zip(generator, range(8)):
+                token.item()
+            tic = time.perf_counter()
+            for (token, _), _ in zip(generator, range(args.max_tokens)):
+                token.item()
+            tps = args.max_tokens / (time.perf_counter() - tic)
+            name = ("fused " if fuse else "") + ("compiled" if compiled else "eager")
+            print(f"{name:>16} {tps:>8.1f}")
+
+
+def batch(args):
+    """
+    Compare the generation throughput of batched decoding per batch size.
+    """
+    model, tokenizer = load(args.model)
+    prompt = mx.array(tokenizer.encode(args.prompt))
+
+    print(f"{'batch':>6} {'tok/s':>8}")
+    for batch_size in args.batch_sizes:
+        tic = time.perf_counter()
+        num_tokens = 0
+        # no eos, so every row generates `max_tokens`
+        for rows, _ in batch_generate_step(
+                [prompt] * batch_size, model, None, args.max_tokens):
+            num_tokens += len(rows)
+        tps = num_tokens / (time.perf_counter() - tic)
+        print(f"{batch_size:>6} {tps:>8.1f}")
+
+
+def _sort_top_p(logits: mx.array, temp: float, top_p: float) -> mx.array:
+    # nucleus sampling over the fully sorted vocabulary, as a reference
+    probs = mx.softmax(logits / temp, axis=-1)
+    sorted_indices = mx.argsort(probs, axis=-1)
+    sorted_probs = mx.take_along_axis(probs, sorted_indices, axis=-1)
+    cumulative_probs = mx.cumsum(sorted_probs, axis=-1)
+    top_probs = mx.where(cumulative_probs > 1 - top_p, sorted_probs, 0)
+    sorted_token = mx.random.categorical(mx.log(top_probs))
+    return sorted_indices.squeeze(0)[sorted_token]
+
+
+def _time(fn, logits: mx.array, iters: int) -> float:
+    for _ in range(10):
+        mx.eval(fn(logits))
+    tic = time.perf_counter()
+    for _ in range(iters):
+        mx.eval(fn(logits))
+    return (time.perf_counter() - tic) / iters * 1e6
+
+
+def sampler(args):
+    """
+    Time sampling one token from random logits per vocabulary size.
+    """
+    configs = {
+        "greedy": lambda x: sample(x, 0.0)[0],
+        "greedy+prob": lambda x: sample(x, 0.0),
+        "temp": lambda x: sample(x, 1.0)[0],
+        "top_k=50": lambda x: sample(x, 1.0, top_k=50)[0],
+        "min_p=0.05": lambda x: sample(x, 1.0, min_p=0.05)[0],
+        "top_p=0.9": lambda x: sample(x, 1.0, top_p=0.9)[0],
+        "top_p=0.9 (full sort)": lambda x: _sort_top_p(x, 1.0, 0.9),
+    }
+    print(f"{'sampler':>22}" + "".join(f"{v:>12}" for v in args.vocab_sizes))
+    logits = [
+        mx.random.normal((1, v)).astype(getattr(mx, args.dtype)) for v in args.vocab_sizes
+    ]
+    mx.eval(logits)
+    for name, fn in configs.items():
+        timings = [_time(fn, x, args.iters) for x in logits]
+        print(f"{name:>22}" + "".join(f"{t:>10.1f}us" for t in timings))
+
+
+def configure_parser() -> argparse.ArgumentParser:
+    """
+    Configures and returns the argument parser for the script.
+
+    Returns:
+        argparse.ArgumentParser: Configured argument parser.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark MLX model inference"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_kv = subparsers.add_parser(
+        "kv-cache", help="Compare quantized KV caches with full precision.")
+    parser_kv.add_argument("--model", type=str, required=True,
+                           help="Path or Hugging Face repo of the model.")
+    parser_kv.add_argument(
+        "--prompt", type=str, default="Write a story about Einstein.",
+        help="Prompt to decode from.")
+    parser_kv.add_argument(
+        "--max-tokens", type=int, default=256, help="Number of tokens to decode.")
+    parser_kv.add_argument(
+        "--kv-bits", type=int, nargs="+", default=[8, 4],
+        help="Quantized cache bit widths to compare.")
+    parser_kv.add_argument(
+        "--kv-group-size", type=int, default=64,
+        help="Group size for cache quantization.")
+    parser_kv.set_defaults(func=kv_cache)
+
+    parser_decode = subparsers.add_parser(
+        "decode", help="Compare eager, compiled and fused decoding.")
+    parser_decode.add_argument("--model", type=str, required=True,
+                               help="Path or Hugging Face repo of the model.")
+    parser_decode.add_argument(
+        "--prompt", type=str, default="Write a story about Einstein.",
+        help="Prompt to decode from.")
+    parser_decode.add_argument(
+        "--max-tokens", type=int, default=256, help="Number of tokens to decode.")
+    parser_decode.set_defaults(func=decode)
+
+    parser_batch = subparsers.add_parser(
+        "batch", help="Compare batched decoding throughput per batch size.")
+    parser_batch.add_argument("--model", type=str, required=True,
+                              help="Path or Hugging Face repo of the model.")
+    parser_batch.add_argument(
+        "--prompt", type=str, default="Write a story about Einstein.",
+        help="Prompt decoded by every row.")
+    parser_batch.add_argument(
+        "--max-tokens", type=int, default=128, help="Number of tokens per row.")
+    parser_batch.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8],
+        help="Batch sizes to compare.")
+    parser_batch.set_defaults(func=batch)
+
+    parser_sampler = subparsers.add_parser(
+        "sampler", help="Time the token samplers.")
+    parser_sampler.add_argument(
+        "--vocab-sizes", type=int, nargs="+", default=[32000, 256000],
+        help="Vocabulary sizes to sample from (Llama and Gemma by default).")
+    parser_sampler.add_argument(
+        "--dtype", type=str, choices=["float16", "bfloat16", "float32"],
+        default="float16", help="Type of the logits.")
+    parser_sampler.add_argument(
+        "--iters", type=int, default=100, help="Number of timed samples.")
+    parser_sampler.set_defaults(func=sampler)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = configure_parser()
+    args = parser.parse_args()
+    args.func(args)
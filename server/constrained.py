@@ -0,0 +1,513 @@
+import functools
+import json
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import mlx.core as mx
+from transformers import PreTrainedTokenizer
+
+# bounds the whitespace between JSON tokens so it can't run on forever
+_WHITESPACE = r"[ \t\n]{0,8}"
+# nesting depth of the values of a schema without a type
+_MAX_DEPTH = 3
+
+
+class _CharSet:
+    __slots__ = ('ranges', 'negated')
+
+    def __init__(self, ranges: List[Tuple[int, int]], negated: bool = False):
+        self.ranges = ranges
+        self.negated = negated
+
+    def __contains__(self, c: str) -> bool:
+        o = ord(c)
+        return any(lo <= o <= hi for lo, hi in self.ranges) != self.negated
+
+
+_CLASSES = {
+    'd': [(48, 57)],
+    'w': [(48, 57), (65, 90), (95, 95), (97, 122)],
+    's': [(9, 13), (32, 32)],
+}
+_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'f': '\f', 'v': '\v', '0': '\0'}
+
+
+class _Parser:
+    """
+    Parse a regular expression into a tree of ('set', _CharSet),
+    ('cat', nodes), ('alt', nodes) and ('rep', node, min, max) nodes.
+
+    Supports literals, escapes, character classes, `.`, groups,
+    alternation and the `*`, `+`, `?` and `{m,n}` quantifiers; the whole
+    text must match, anchors are ignored.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.i = 0
+
+    def parse(self):
+        node = self._alt()
+        if self.i < len(self.pattern):
+            raise ValueError(f"Unexpected {self.pattern[self.i]!r} at {self.i} in regex")
+        return node
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.i] if self.i < len(self.pattern) else None
+
+    def _next(self) -> str:
+        if self.i >= len(self.pattern):
+            raise ValueError("Unexpected end of regex")
+        self.i += 1
+        return self.pattern[self.i - 1]
+
+    def _alt(self):
+        nodes = [self._cat()]
+        while self._peek() == '|':
+            self.i += 1
+            nodes.append(self._cat())
+        return nodes[0] if len(nodes) == 1 else ('alt', nodes)
+
+    def _cat(self):
+        nodes = []
+        while self._peek() not in (None, '|', ')'):
+            nodes.append(self._repeat())
+        return ('cat', nodes)
+
+    def _repeat(self):
+        node = self._atom()
+        while True:
+            c = self._peek()
+            if c == '*':
+                bounds = (0, None)
+            elif c == '+':
+                bounds = (1, None)
+            elif c == '?':
+                bounds = (0, 1)
+            elif c == '{' and re.match(r"\{\d+(,\d*)?\}", self.pattern[self.i:]):
+                end = self.pattern.index('}', self.i)
+                lo, comma, hi = self.pattern[self.i + 1:end].partition(',')
+                bounds = (int(lo), int(hi) if hi else None if comma else int(lo))
+                self.i = end
+            else:
+                return node
+            self.i += 1
+            # lazy and possessive modifiers don't change what matches
+            if self._peek() in ('?', '+'):
+                self.i += 1
+            node = ('rep', node, *bounds)
+
+    def _atom(self):
+        c = self._next()
+        if c == '(':
+            if self.pattern.startswith('?:', self.i):
+                self.i += 2
+            node = self._alt()
+            if self._next() != ')':
+                raise ValueError("Unbalanced parenthesis in regex")
+            return node
+        if c == '[':
+            return ('set', self._class())
+        if c == '.':
+            return ('set', _CharSet([(10, 10)], negated=True))
+        if c in '^$':
+            return ('cat', [])
+        if c == '\\':
+            return ('set', self._escape())
+        return ('set', _CharSet([(ord(c), ord(c))]))
+
+    def _escape(self, in_class: bool = False) -> _CharSet:
+        c = self._next()
+        if c.lower() in _CLASSES:
+            if in_class and c.isupper():
+                raise ValueError(f"\\{c} is not supported in a character class")
+            return _CharSet(_CLASSES[c.lower()], negated=c.isupper())
+        if c in 'xu':
+            n = 2 if c == 'x' else 4
+            code = int(self.pattern[self.i:self.i + n], 16)
+            self.i += n
+            return _CharSet([(code, code)])
+        c = _ESCAPES.get(c, c)
+        return _CharSet([(ord(c), ord(c))])
+
+    def _class(self) -> _CharSet:
+        negated = self._peek() == '^'
+        if negated:
+            self.i += 1
+        ranges = []
+        first = True
+        while first or self._peek() != ']':
+            first = False
+            c = self._next()
+            if c == '\\':
+                charset = self._escape(in_class=True)
+                if len(charset.ranges) > 1 or charset.ranges[0][0] != charset.ranges[0][1]:
+                    ranges.extend(charset.ranges)
+                    continue
+                lo = charset.ranges[0][0]
+            else:
+                lo = ord(c)
+            hi = lo
+            if self._peek() == '-' and self.pattern[self.i + 1:self.i + 2] not in ('', ']'):
+                self.i += 1
+                c = self._next()
+                hi = self._escape().ranges[0][0] if c == '\\' else ord(c)
+            ranges.append((lo, hi))
+        self.i += 1
+        return _CharSet(ranges, negated)
+
+
+class _DFA:
+    """
+    Character level automaton of a regular expression.
+
+    The Thompson NFA of the expression is determinized lazily, a state and
+    its transitions are only built the first time they are reached.
+    """
+
+    def __init__(self, pattern: str):
+        self._eps: List[List[int]] = []
+        self._edges: List[List[Tuple[_CharSet, int]]] = []
+        start = self._new()
+        self._accept = self._compile(_Parser(pattern).parse(), start)
+
+        self._sets: List[frozenset] = []
+        self._ids: Dict[frozenset, int] = {}
+        self._trans: List[Dict[str, int]] = []
+        self.start = self._state(self._closure({start}))
+
+    def _new(self) -> int:
+        self._eps.append([])
+        self._edges.append([])
+        return len(self._eps) - 1
+
+    def _compile(self, node, start: int) -> int:
+        kind = node[0]
+        if kind == 'set':
+            end = self._new()
+            self._edges[start].append((node[1], end))
+            return end
+        if kind == 'cat':
+            for child in node[1]:
+                start = self._compile(child, start)
+            return start
+        if kind == 'alt':
+            end = self._new()
+            for child in node[1]:
+                s = self._new()
+                self._eps[start].append(s)
+                self._eps[self._compile(child, s)].append(end)
+            return end
+
+        _, child, lo, hi = node
+        for _ in range(lo):
+            start = self._compile(child, start)
+        if hi is None:
+            loop = self._new()
+            self._eps[start].append(loop)
+            self._eps[self._compile(child, loop)].append(loop)
+            return loop
+        ends = [start]
+        for _ in range(hi - lo):
+            ends.append(self._compile(child, ends[-1]))
+        end = self._new()
+        for s in ends:
+            self._eps[s].append(end)
+        return end
+
+    def _closure(self, states) -> frozenset:
+        stack, seen = list(states), set(states)
+        while stack:
+            for s in self._eps[stack.pop()]:
+                if s not in seen:
+                    seen.add(s)
+                    stack.append(s)
+        return frozenset(seen)
+
+    def _state(self, states: frozenset) -> int:
+        if not states:
+            return -1
+        if states not in self._ids:
+            self._ids[states] = len(self._sets)
+            self._sets.append(states)
+            self._trans.append({})
+        return self._ids[states]
+
+    def step(self, state: int, c: str) -> int:
+        """
+        The state after `c`, -1 if no match can continue.
+        """
+        trans = self._trans[state]
+        if c not in trans:
+            trans[c] = self._state(self._closure({
+                end for s in self._sets[state] for charset, end in self._edges[s]
+                if c in charset
+            }))
+        return trans[c]
+
+    def accepting(self, state: int) -> bool:
+        return self._accept in self._sets[state]
+
+
+@functools.lru_cache(maxsize=4)
+def _token_trie(tokenizer: PreTrainedTokenizer):
+    """
+    Trie of the text of every token of the vocabulary, as nested
+    (children, token ids) tuples.
+
+    Special tokens and tokens decoding to an incomplete UTF-8 sequence
+    (byte fallback) are left out, they can't be matched character-wise.
+    """
+    ids = list(range(len(tokenizer)))
+    pieces = tokenizer.convert_ids_to_tokens(ids)
+    special = set(tokenizer.all_special_ids)
+    root = ({}, [])
+    for i, piece, text in zip(ids, pieces, tokenizer.batch_decode([[i] for i in ids])):
+        if i in special or not text or '\ufffd' in text:
+            continue
+        # SentencePiece drops the leading space of a lone token
+        if piece.startswith('\u2581') and not text.startswith(' '):
+            text = ' ' + text
+        node = root
+        for c in text:
+            node = node[0].setdefault(c, ({}, []))
+        node[1].append(i)
+    return root
+
+
+class TokenIndex:
+    """
+    Token level automaton of a regular expression over a tokenizer's
+    vocabulary.
+
+    Each state of the character automaton gets a table of the tokens whose
+    whole text it can consume and the state they lead to, found with one
+    walk of the vocabulary's trie pruned where no match can continue, and
+    the allowed tokens as a boolean mask on the device. The tables of the
+    first `max_states` states reachable from the start are built with the
+    index, on the thread creating it instead of the one decoding, the
+    others the first time they are reached. The masks of the
+    `max_masks` most recently used states are kept. An index is shared by
+    all the generations with the same tokenizer and expression.
+
+    Args:
+        tokenizer (PreTrainedTokenizer): The tokenizer of the model.
+        pattern (str): The regular expression the generated text matches.
+        max_states (int): Number of states whose tables are built up front.
+        max_masks (int): Number of state masks kept on the device.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizer,
+        pattern: str,
+        max_states: int = 256,
+        max_masks: int = 64,
+    ):
+        self.dfa = _DFA(pattern)
+        self.eos_token_id = tokenizer.eos_token_id
+        self.max_masks = max_masks
+        self._trie = _token_trie(tokenizer)
+        self._next: Dict[int, Dict[int, int]] = {}
+        self._masks: OrderedDict[int, mx.array] = OrderedDict()
+        self._build(max_states)
+
+    @property
+    def start(self) -> int:
+        return self.dfa.start
+
+    def _build(self, max_states: int):
+        # breadth first, the states a generation reaches first come first
+        queue, seen = [self.start], {self.start}
+        for state in queue:
+            if len(self._next) >= max_states:
+                break
+            for t in self.next_states(state).values():
+                if t not in seen:
+                    seen.add(t)
+                    queue.append(t)
+
+    def next_states(self, state: int) -> Dict[int, int]:
+        """
+        The allowed tokens in `state` and the states they lead to.
+        """
+        if state not in self._next:
+            allowed = {}
+            stack = [(self._trie, state)]
+            while stack:
+                (children, _), s = stack.pop()
+                for c, child in children.items():
+                    t = self.dfa.step(s, c)
+                    if t < 0:
+                        continue
+                    for token in child[1]:
+                        allowed[token] = t
+                    stack.append((child, t))
+            self._next[state] = allowed
+        return self._next[state]
+
+    def mask(self, state: int, vocab_size: int) -> mx.array:
+        """
+        Boolean mask of shape (vocab_size,) of the allowed tokens in `state`,
+        the end of sequence token is allowed once the text can end.
+        """
+        if state in self._masks:
+            self._masks.move_to_end(state)
+            return self._masks[state]
+
+        tokens = list(self.next_states(state))
+        if self.eos_token_id is not None and (
+                self.dfa.accepting(state) or not tokens):
+            tokens.append(self.eos_token_id)
+        # the tokenizer can have more tokens than the model has logits
+        tokens = [t for t in tokens if t < vocab_size]
+        mask = mx.zeros((vocab_size,), mx.bool_)
+        if tokens:
+            mask[mx.array(tokens)] = True
+        self._masks[state] = mask
+        if len(self._masks) > self.max_masks:
+            self._masks.popitem(last=False)
+        return mask
+
+
+@functools.lru_cache(maxsize=16)
+def _token_index(tokenizer: PreTrainedTokenizer, pattern: str) -> TokenIndex:
+    return TokenIndex(tokenizer, pattern)
+
+
+def _json_literal(value) -> str:
+    return re.escape(json.dumps(value))
+
+
+def _json_object(value: str) -> str:
+    # any members, whose values match `value`
+    string = _json_schema_regex({'type': 'string'})
+    member = f"{string}{_WHITESPACE}:{_WHITESPACE}{value}"
+    return rf"\{{{_WHITESPACE}(?:{member}(?:{_WHITESPACE},{_WHITESPACE}{member})*)?{_WHITESPACE}\}}"
+
+
+def _json_value(depth: int) -> str:
+    values = [
+        _json_schema_regex({'type': t})
+        for t in ('string', 'number', 'boolean', 'null')
+    ]
+    if depth > 0:
+        value = _json_value(depth - 1)
+        values.append(_json_object(value))
+        values.append(
+            rf"\[{_WHITESPACE}(?:{value}(?:{_WHITESPACE},{_WHITESPACE}{value})*)?{_WHITESPACE}\]")
+    return '(?:' + '|'.join(values) + ')'
+
+
+def _json_schema_regex(schema: dict) -> str:
+    if 'const' in schema:
+        return _json_literal(schema['const'])
+    if 'enum' in schema:
+        return '(?:' + '|'.join(_json_literal(v) for v in schema['enum']) + ')'
+    for key in ('anyOf', 'oneOf'):
+        if key in schema:
+            return '(?:' + '|'.join(_json_schema_regex(s) for s in schema[key]) + ')'
+
+    kind = schema.get('type')
+    if isinstance(kind, list):
+        return '(?:' + '|'.join(
+            _json_schema_regex(dict(schema, type=t)) for t in kind) + ')'
+    if kind is None:
+        return _json_value(_MAX_DEPTH)
+    if kind == 'string':
+        if 'pattern' in schema:
+            return f'"(?:{schema["pattern"]})"'
+        lo = schema.get('minLength', 0)
+        hi = schema.get('maxLength', '')
+        return rf'"(?:[^"\\\x00-\x1f]|\\["\\/bfnrt]){{{lo},{hi}}}"'
+    if kind == 'integer':
+        return r"-?(?:0|[1-9][0-9]{0,15})"
+    if kind == 'number':
+        return r"-?(?:0|[1-9][0-9]{0,15})(?:\.[0-9]{1,16})?(?:[eE][+-]?[0-9]{1,3})?"
+    if kind == 'boolean':
+        return r"(?:true|false)"
+    if kind == 'null':
+        return r"null"
+    if kind == 'array':
+        item = _json_schema_regex(schema.get('items', {}))
+        lo = schema.get('minItems', 0)
+        hi = schema.get('maxItems')
+        more = f"(?:{_WHITESPACE},{_WHITESPACE}{item})"
+        if hi is not None:
+            items = f"{item}{more}{{{max(lo - 1, 0)},{hi - 1}}}" if hi > 0 else ''
+        else:
+            items = f"{item}{more}{{{max(lo - 1, 0)},}}"
+        if lo == 0 and items:
+            items = f"(?:{items})?"
+        return rf"\[{_WHITESPACE}{items}{_WHITESPACE}\]"
+    if kind == 'object':
+        properties = schema.get('properties')
+        if not properties:
+            return _json_object(_json_value(_MAX_DEPTH - 1))
+        members = [
+            f"{_json_literal(name)}{_WHITESPACE}:{_WHITESPACE}{_json_schema_regex(s)}"
+            for name, s in properties.items()
+        ]
+        separator = f"{_WHITESPACE},{_WHITESPACE}"
+        return rf"\{{{_WHITESPACE}{separator.join(members)}{_WHITESPACE}\}}"
+    raise ValueError(f"Unsupported JSON schema type {kind!r}")
+
+
+def json_schema_regex(schema: dict) -> str:
+    """
+    Regular expression of the JSON documents matching `schema`.
+
+    Supports the `string` (with `pattern`, `minLength` and `maxLength`),
+    `integer`, `number`, `boolean`, `null`, `array` (with `items`,
+    `minItems` and `maxItems`) and `object` types, `enum`, `const`,
+    `anyOf` and `oneOf`. Every property of an object is generated, in
+    order, an object without properties accepts any members, and a schema
+    without a type accepts any JSON value, nested up to a fixed depth.
+    """
+    return _json_schema_regex(schema)
+
+
+class Constraint:
+    """
+    Constrain the generated tokens to the text matching a regular expression.
+
+    Every step masks the logits of the disallowed tokens with the mask of
+    the current state, a single `mx.where` on the device, and the sampled
+    token then advances the state on the host. The end of sequence token is
+    only allowed once the text is a complete match.
+
+    Args:
+        index (TokenIndex): The token automaton, shared between constraints.
+    """
+
+    def __init__(self, index: TokenIndex):
+        self.index = index
+        self.state = index.start
+
+    @classmethod
+    def from_regex(cls, tokenizer: PreTrainedTokenizer, pattern: str) -> 'Constraint':
+        return cls(_token_index(tokenizer, pattern))
+
+    @classmethod
+    def from_json_schema(cls, tokenizer: PreTrainedTokenizer, schema: dict) -> 'Constraint':
+        return cls.from_regex(tokenizer, json_schema_regex(schema))
+
+    def copy(self) -> 'Constraint':
+        constraint = Constraint(self.index)
+        constraint.state = self.state
+        return constraint
+
+    def __call__(self, logits: mx.array) -> mx.array:
+        """
+        Mask the logits of shape (1, vocab_size) of the disallowed tokens.
+        """
+        mask = self.index.mask(self.state, logits.shape[-1])
+        return mx.where(mask, logits, -float("inf"))
+
+    def advance(self, token: int):
+        """
+        Move past a generated token.
+        """
+        if token != self.index.eos_token_id:
+            self.state = self.index.next_states(self.state)[token]
@@ -0,0 +1,147 @@
+from collections import deque
+from typing import Dict, List
+
+from transformers import PreTrainedTokenizer
+
+REPLACEMENT_CHAR = "\ufffd"
+
+
+class StreamingDetokenizer:
+    """
+    Incrementally turn generated token ids into text.
+
+    Each token only decodes a short window: the tokens since the last
+    emitted segment plus the ones before them, for tokenizers whose
+    decoding of a token depends on its predecessor (SentencePiece leading
+    spaces). The text of the window minus that of its prefix is the new
+    segment. A window decoding to a trailing replacement character ends in
+    an incomplete UTF-8 sequence, it is held back until the next tokens
+    complete it.
+
+    Args:
+        tokenizer (PreTrainedTokenizer): The tokenizer of the model.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer):
+        self.tokenizer = tokenizer
+        self.reset()
+
+    def reset(self):
+        self.tokens: List[int] = []
+        self.text = ""
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    def _segment(self) -> str:
+        prefix = self.tokenizer.decode(
+            self.tokens[self._prefix_offset:self._read_offset])
+        window = self.tokenizer.decode(self.tokens[self._prefix_offset:])
+        return window[len(prefix):]
+
+    def add_token(self, token: int) -> str:
+        """
+        Add a generated token.
+
+        Returns:
+            str: The newly completed text, empty while held back.
+        """
+        self.tokens.append(token)
+        segment = self._segment()
+        if not segment or segment.endswith(REPLACEMENT_CHAR):
+            return ""
+
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self.tokens)
+        self.text += segment
+        return segment
+
+    def finalize(self) -> str:
+        """
+        Flush the held back text once generation is over, dropping a
+        trailing incomplete byte sequence.
+
+        Returns:
+            str: The remaining text.
+        """
+        segment = self._segment().rstrip(REPLACEMENT_CHAR)
+        self._prefix_offset = self._read_offset = len(self.tokens)
+        self.text += segment
+        return segment
+
+
+class StopMatcher:
+    """
+    Match stop strings incrementally on the detokenized stream.
+
+    The stop strings are compiled into an Aho-Corasick automaton, so each
+    character of the stream is a single transition however many stop
+    strings there are. The depth of the current state is the length of the
+    longest suffix of the text that may still grow into a stop string,
+    that text is `held` back from streaming until it is resolved.
+
+    Args:
+        stop (List[str]): The stop strings, empty ones are ignored.
+    """
+
+    def __init__(self, stop: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        # length of the longest stop string ending at each state
+        self._match = [0]
+        for s in filter(None, stop):
+            state = 0
+            for c in s:
+                if c not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[state] + 1)
+                    self._match.append(0)
+                    self._goto[state][c] = len(self._goto) - 1
+                state = self._goto[state][c]
+            self._match[state] = len(s)
+
+        # breadth first, so the fail state of a node is final before its children
+        order = deque(self._goto[0].values())
+        while order:
+            state = order.popleft()
+            for c, child in self._goto[state].items():
+                self._fail[child] = self._next(self._fail[state], c)
+                self._match[child] = max(
+                    self._match[child], self._match[self._fail[child]])
+                order.append(child)
+
+        self.text = ""
+        self.stopped = False
+        self._state = 0
+
+    def _next(self, state: int, c: str) -> int:
+        while state and c not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(c, 0)
+
+    @property
+    def held(self) -> int:
+        """
+        Number of trailing characters of `text` which may start a stop string.
+        """
+        return 0 if self.stopped else self._depth[self._state]
+
+    def feed(self, segment: str) -> bool:
+        """
+        Add a segment of the stream, `text` is cut before the first stop string.
+
+        Returns:
+            bool: True once a stop string was generated.
+        """
+        if self.stopped:
+            return True
+        for i, c in enumerate(segment):
+            self._state = self._next(self._state, c)
+            if self._match[self._state]:
+                end = len(self.text) + i + 1
+                self.text = (self.text + segment)[:end - self._match[self._state]]
+                self.stopped = True
+                return True
+        self.text += segment
+        return False
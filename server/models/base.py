@@ -1,5 +1,12 @@
+import copy
 import inspect
 from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import mlx.core as mx
+import mlx.nn as nn
+from mlx.utils import tree_map
 
 
 @dataclass
@@ -13,3 +20,435 @@ class BaseModelArgs:
                 if k in inspect.signature(cls).parameters
             }
         )
+
+
+def fuse_linears(linears: List[nn.Module]) -> nn.Module:
+    """
+    Fuse linear layers applied to the same input into one layer.
+
+    The parameters of the (quantized) linears are concatenated along their
+    output dimension, so one matmul computes all the projections and the
+    output is split back by the caller.
+    """
+    fused = copy.copy(linears[0])
+    for k in linears[0]:
+        fused[k] = mx.concatenate([linear[k] for linear in linears], axis=0)
+    return fused
+
+
+# masks up to this many entries are cached, at most 32 MB with float32 masks
+_MAX_CACHED_MASK_SIZE = 1 << 18
+
+
+def _causal_mask(
+    N: int,
+    offset: int,
+    dtype: mx.Dtype,
+    window: Optional[int],
+    keep: int,
+) -> mx.array:
+    queries = mx.arange(offset, offset + N)[:, None]
+    keys = mx.arange(offset + N)[None]
+    visible = keys <= queries
+    if window is not None:
+        visible = visible & ((keys < keep) | (queries - keys < window))
+    return mx.where(visible, 0.0, -1e9).astype(dtype)
+
+
+_cached_causal_mask = lru_cache(maxsize=32)(_causal_mask)
+
+
+def create_causal_mask(
+    N: int,
+    offset: int,
+    dtype: mx.Dtype,
+    window: Optional[int] = None,
+    keep: int = 0,
+) -> mx.array:
+    """
+    Additive causal mask of `N` new positions over `offset` cached ones.
+
+    With a `window` every position only attends to the first `keep`
+    positions and its `window` most recent ones. Small masks are cached,
+    so repeated short prefills at the same offset reuse them. The masks of
+    long contexts are built per forward instead of staying pinned in
+    memory.
+    """
+    if N * (offset + N) <= _MAX_CACHED_MASK_SIZE:
+        return _cached_causal_mask(N, offset, dtype, window, keep)
+    return _causal_mask(N, offset, dtype, window, keep)
+
+
+class KVCache:
+    """
+    Per-layer key/value cache grown in fixed size blocks.
+
+    Storage is preallocated `step` positions at a time and new keys/values
+    are written in place at `offset`, so a decode step copies only the new
+    token instead of the whole cache.
+    """
+
+    def __init__(self, step: int = 256):
+        self.keys = None
+        self.values = None
+        self.offset = 0
+        self.step = step
+
+    def update_and_fetch(self, keys: mx.array, values: mx.array) -> Tuple[mx.array, mx.array]:
+        prev = self.offset
+        if self.keys is None or (prev + keys.shape[2]) > self.keys.shape[2]:
+            B, n_kv_heads, L, k_head_dim = keys.shape
+            v_head_dim = values.shape[3]
+            n_steps = (self.step + L - 1) // self.step
+            k_shape = (B, n_kv_heads, n_steps * self.step, k_head_dim)
+            v_shape = (B, n_kv_heads, n_steps * self.step, v_head_dim)
+            new_k = mx.zeros(k_shape, keys.dtype)
+            new_v = mx.zeros(v_shape, values.dtype)
+            if self.keys is not None:
+                if prev % self.step != 0:
+                    self.keys = self.keys[..., :prev, :]
+                    self.values = self.values[..., :prev, :]
+                self.keys = mx.concatenate([self.keys, new_k], axis=2)
+                self.values = mx.concatenate([self.values, new_v], axis=2)
+            else:
+                self.keys, self.values = new_k, new_v
+
+        self.offset += keys.shape[2]
+        self.keys[..., prev:self.offset, :] = keys
+        self.values[..., prev:self.offset, :] = values
+        return self.keys[..., :self.offset, :], self.values[..., :self.offset, :]
+
+    def trim(self, n: int) -> int:
+        """
+        Drop the last `n` cached positions, e.g. rejected speculative tokens.
+        """
+        n = min(self.offset, n)
+        self.offset -= n
+        return n
+
+    def make_mask(self, N: int, dtype: mx.Dtype) -> mx.array:
+        """
+        Additive causal mask of `N` new positions over the cached ones.
+        """
+        return create_causal_mask(N, self.offset, dtype)
+
+    def repeat(self, n: int):
+        """
+        Repeat the cached rows `n` times along the batch axis, e.g. to
+        sample several completions of one prefilled prompt.
+        """
+        self.keys, self.values = tree_map(
+            lambda x: mx.repeat(x, n, axis=0), (self.keys, self.values))
+
+    @property
+    def size(self) -> int:
+        """
+        Number of cached positions, `offset` unless some were evicted.
+        """
+        return self.offset
+
+    @property
+    def state(self) -> Tuple[mx.array, mx.array]:
+        """
+        The valid (B, n_kv_heads, size, head_dim) keys and values.
+        """
+        return self.keys[..., :self.offset, :], self.values[..., :self.offset, :]
+
+    @state.setter
+    def state(self, v: Tuple[mx.array, mx.array]):
+        self.keys, self.values = v
+        self.offset = self.keys.shape[2]
+
+    @property
+    def raw_state(self):
+        """
+        The valid keys and values in their stored format, so they can be
+        saved and restored without a conversion.
+        """
+        return self.state
+
+    @raw_state.setter
+    def raw_state(self, v):
+        self.state = v
+
+    @property
+    def nbytes(self) -> int:
+        return sum(x.nbytes for x in self.state)
+
+    @property
+    def dtype(self) -> mx.Dtype:
+        return self.keys.dtype
+
+
+class QuantizedKVCache(KVCache):
+    """
+    KVCache storing keys and values group-quantized to `bits`.
+
+    New entries are quantized on write and the cache is dequantized on
+    read, cutting its memory by roughly 16 / `bits` at the cost of the
+    quantization error.
+    """
+
+    def __init__(self, group_size: int = 64, bits: int = 8, step: int = 256):
+        super().__init__(step)
+        self.group_size = group_size
+        self.bits = bits
+
+    def _quantize(self, x: mx.array) -> Tuple[mx.array, mx.array, mx.array]:
+        shape = x.shape[:-1]
+        quantized = mx.quantize(
+            x.reshape(-1, x.shape[-1]), group_size=self.group_size, bits=self.bits)
+        return tuple(q.reshape(*shape, -1) for q in quantized)
+
+    def _dequantize(self, w: mx.array, scales: mx.array, biases: mx.array) -> mx.array:
+        shape = w.shape[:-1]
+        x = mx.dequantize(
+            w.reshape(-1, w.shape[-1]),
+            scales.reshape(-1, scales.shape[-1]),
+            biases.reshape(-1, biases.shape[-1]),
+            group_size=self.group_size,
+            bits=self.bits,
+        )
+        return x.reshape(*shape, -1)
+
+    def update_and_fetch(self, keys: mx.array, values: mx.array) -> Tuple[mx.array, mx.array]:
+        prev = self.offset
+        keys, values = self._quantize(keys), self._quantize(values)
+        if self.keys is None or (prev + keys[0].shape[2]) > self.keys[0].shape[2]:
+            n_steps = (self.step + keys[0].shape[2] - 1) // self.step
+
+            def grow(buffer, new):
+                shape = new[0].shape[:2] + (n_steps * self.step,)
+                empty = tuple(mx.zeros(shape + x.shape[3:], x.dtype) for x in new)
+                if buffer is None:
+                    return empty
+                return tuple(
+                    mx.concatenate([b[..., :prev, :], e], axis=2)
+                    for b, e in zip(buffer, empty)
+                )
+
+            self.keys, self.values = grow(self.keys, keys), grow(self.values, values)
+
+        self.offset += keys[0].shape[2]
+        for buffer, new in ((self.keys, keys), (self.values, values)):
+            for b, x in zip(buffer, new):
+                b[..., prev:self.offset, :] = x
+        return self.state
+
+    @property
+    def state(self) -> Tuple[mx.array, mx.array]:
+        return tuple(
+            self._dequantize(*(x[..., :self.offset, :] for x in buffer))
+            for buffer in (self.keys, self.values)
+        )
+
+    @state.setter
+    def state(self, v: Tuple[mx.array, mx.array]):
+        keys, values = v
+        self.keys, self.values = self._quantize(keys), self._quantize(values)
+        self.offset = keys.shape[2]
+
+    @property
+    def raw_state(self) -> Tuple[Tuple[mx.array, ...], Tuple[mx.array, ...]]:
+        # the quantized (w, scales, biases) of the keys and the values
+        return tree_map(lambda x: x[..., :self.offset, :], (self.keys, self.values))
+
+    @raw_state.setter
+    def raw_state(self, v: Tuple[Tuple[mx.array, ...], Tuple[mx.array, ...]]):
+        self.keys, self.values = v
+        self.offset = self.keys[0].shape[2]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            x[..., :self.offset, :].nbytes
+            for buffer in (self.keys, self.values) for x in buffer
+        )
+
+    @property
+    def dtype(self) -> mx.Dtype:
+        # the scales carry the dtype the cache dequantizes to
+        return self.keys[1].dtype
+
+
+class RotatingKVCache(KVCache):
+    """
+    KVCache holding at most `max_size` positions.
+
+    The first `keep` positions are kept as attention sinks and the rest is
+    a ring buffer of the most recent ones, so memory stays constant however
+    long the session runs. `offset` keeps counting every position and
+    cached keys keep their original rotation, so RoPE distances inside the
+    window are exact. With `keep=0` this is sliding window attention.
+
+    Single token updates overwrite the oldest position in place. Multi
+    token updates are appended to the ordered window, so every new
+    position sees its full window (see `make_mask`), and the excess is
+    dropped by the next single token update.
+    """
+
+    def __init__(self, max_size: int, keep: int = 4, step: int = 256):
+        super().__init__(step)
+        if max_size <= keep:
+            raise ValueError(
+                f"max_size must be larger than keep, got {max_size} and {keep}")
+        self.max_size = max_size
+        self.keep = keep
+        # number of valid buffer slots and the next slot written
+        self._size = 0
+        self._idx = 0
+
+    def _ordered(self) -> Tuple[mx.array, mx.array]:
+        if self._idx == self._size:
+            return self.keys[..., :self._size, :], self.values[..., :self._size, :]
+        # the ring wrapped, the oldest window position is at `_idx`
+        return tuple(
+            mx.concatenate([
+                x[..., :self.keep, :],
+                x[..., self._idx:self._size, :],
+                x[..., self.keep:self._idx, :],
+            ], axis=2)
+            for x in (self.keys, self.values)
+        )
+
+    def _window(self, x: mx.array, n: int) -> mx.array:
+        # the sinks and the most recent `n - keep` positions
+        if x.shape[2] <= n:
+            return x
+        return mx.concatenate(
+            [x[..., :self.keep, :], x[..., x.shape[2] - n + self.keep:, :]], axis=2)
+
+    def update_and_fetch(self, keys: mx.array, values: mx.array) -> Tuple[mx.array, mx.array]:
+        if keys.shape[2] == 1:
+            return self._update_in_place(keys, values)
+        return self._update_concat(keys, values)
+
+    def _update_in_place(self, keys: mx.array, values: mx.array) -> Tuple[mx.array, mx.array]:
+        if self.keys is not None and self.keys.shape[2] > self.max_size:
+            # drop what a multi token update left past the window
+            self.keys, self.values = (self._window(x, self.max_size) for x in self._ordered())
+            self._size = self._idx = self.max_size
+
+        if self._size < self.max_size:
+            if self.keys is None or self._size == self.keys.shape[2]:
+                B, n_kv_heads, _, k_head_dim = keys.shape
+                n = min(self.step, self.max_size - self._size)
+                new_k = mx.zeros((B, n_kv_heads, n, k_head_dim), keys.dtype)
+                new_v = mx.zeros((B, n_kv_heads, n, values.shape[3]), values.dtype)
+                if self.keys is None:
+                    self.keys, self.values = new_k, new_v
+                else:
+                    self.keys = mx.concatenate([self.keys, new_k], axis=2)
+                    self.values = mx.concatenate([self.values, new_v], axis=2)
+            self._size += 1
+            self._idx = self._size
+        elif self._idx == self.max_size:
+            self._idx = self.keep + 1
+        else:
+            self._idx += 1
+
+        self.offset += 1
+        self.keys[..., self._idx - 1:self._idx, :] = keys
+        self.values[..., self._idx - 1:self._idx, :] = values
+        return self.keys[..., :self._size, :], self.values[..., :self._size, :]
+
+    def _update_concat(self, keys: mx.array, values: mx.array) -> Tuple[mx.array, mx.array]:
+        if self.keys is None:
+            self.keys, self.values = keys, values
+        else:
+            # the first new position attends to the `max_size - 1` before it
+            self.keys, self.values = (
+                mx.concatenate([self._window(x, self.max_size - 1), new], axis=2)
+                for x, new in zip(self._ordered(), (keys, values))
+            )
+        self.offset += keys.shape[2]
+        self._size = self._idx = self.keys.shape[2]
+        return self.keys, self.values
+
+    def make_mask(self, N: int, dtype: mx.Dtype) -> mx.array:
+        """
+        Additive causal mask of `N` new positions over the cached window,
+        limiting every position to the sinks and its `max_size - keep`
+        most recent positions.
+        """
+        prefix = min(self._size, self.max_size - 1)
+        return create_causal_mask(
+            N, prefix, dtype, self.max_size - self.keep, self.keep)
+
+    def trim(self, n: int) -> int:
+        n = min(self._size, n)
+        self.keys, self.values = (x[..., :self._size - n, :] for x in self._ordered())
+        self._size = self._idx = self._size - n
+        self.offset -= n
+        return n
+
+    @property
+    def size(self) -> int:
+        return min(self._size, self.max_size)
+
+    @property
+    def state(self) -> Tuple[mx.array, mx.array]:
+        """
+        The sinks and most recent window positions in order.
+        """
+        return tuple(self._window(x, self.max_size) for x in self._ordered())
+
+    @state.setter
+    def state(self, v: Tuple[mx.array, mx.array]):
+        keys, values = v
+        self.offset = keys.shape[2]
+        self.keys, self.values = (self._window(x, self.max_size) for x in v)
+        self._size = self._idx = self.keys.shape[2]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(x[..., :self._size, :].nbytes for x in (self.keys, self.values))
+
+
+class StaticKVCache(KVCache):
+    """
+    KVCache of a fixed capacity whose `offset` is an array.
+
+    Updates write the new position in place and every call returns the
+    whole buffer, so the shapes seen by a decode step never change and it
+    can be compiled. Positions past `offset` must be masked out by the
+    caller.
+    """
+
+    def __init__(self, keys: mx.array, values: mx.array, offset: mx.array):
+        super().__init__()
+        self.keys = keys
+        self.values = values
+        self.offset = offset
+
+    def update_and_fetch(self, keys: mx.array, values: mx.array) -> Tuple[mx.array, mx.array]:
+        self.keys = mx.slice_update(self.keys, keys, self.offset, axes=(2,))
+        self.values = mx.slice_update(self.values, values, self.offset, axes=(2,))
+        self.offset = self.offset + keys.shape[2]
+        return self.keys, self.values
+
+
+def make_kv_cache(
+    num_layers: int,
+    kv_bits: Optional[int] = None,
+    kv_group_size: int = 64,
+    max_kv_size: Optional[int] = None,
+    sliding_window: Optional[int] = None,
+) -> List[KVCache]:
+    """
+    Create empty per-layer caches.
+
+    The caches are group-quantized if `kv_bits` is set. With `max_kv_size`
+    they keep 4 attention sinks and the most recent positions, otherwise
+    with the model's `sliding_window` only the most recent positions.
+    """
+    if max_kv_size is None and sliding_window is None:
+        if kv_bits is None:
+            return [KVCache() for _ in range(num_layers)]
+        return [QuantizedKVCache(kv_group_size, kv_bits) for _ in range(num_layers)]
+
+    if kv_bits is not None:
+        raise ValueError("kv_bits is not supported with a bounded KV cache")
+    if max_kv_size is not None:
+        return [RotatingKVCache(max_kv_size) for _ in range(num_layers)]
+    return [RotatingKVCache(sliding_window, keep=0) for _ in range(num_layers)]
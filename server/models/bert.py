@@ -7,6 +7,7 @@ from dataclasses import dataclass
 from typing import List, Dict, Optional, Tuple, Union, Callable
 
 from .base import BaseModelArgs
+from .layers import blockwise_attention
 
 
 @dataclass
@@ -35,6 +36,7 @@ class ModelArgs(BaseModelArgs):
     output_attentions: bool = False
     output_hidden_states: bool = False
     use_return_dict: bool = True
+    attention_block_size: Optional[int] = None
 
 
 def apply_chunking_to_forward(
@@ -216,6 +218,9 @@ class BertSelfAttention(nn.Module):
                 2 * config.max_position_embeddings - 1, self.attention_head_size)
 
         self.is_decoder = config.is_decoder
+        # attend to the keys in blocks of this size when the attention
+        # probabilities are not needed
+        self.block_size = getattr(config, "attention_block_size", None)
 
     def transpose_for_scores(self, x: mx.array) -> mx.array:
         new_x_shape = x.shape[
@@ -273,6 +278,29 @@ class BertSelfAttention(nn.Module):
             # if encoder bi-directional self-attention `past_key_value` is always `None`
             past_key_value = (key_layer, value_layer)
 
+        if (
+            self.block_size is not None
+            and self.position_embedding_type == "absolute"
+            and head_mask is None
+            and not output_attentions
+            and not self.training
+        ):
+            context_layer = blockwise_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                1 / math.sqrt(self.attention_head_size),
+                attention_mask,
+                self.block_size,
+            )
+            context_layer = context_layer.transpose([0, 2, 1, 3])
+            context_layer = context_layer.reshape(
+                context_layer.shape[:-2] + (self.all_head_size,))
+            outputs = (context_layer,)
+            if self.is_decoder:
+                outputs = outputs + (past_key_value,)
+            return outputs
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = mx.matmul(
             query_layer, key_layer.transpose([0, 1, -1, -2]))
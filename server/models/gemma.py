@@ -1,11 +1,12 @@
 from dataclasses import dataclass
 from functools import partial
-from typing import Optional, Tuple
+from typing import Optional
 
 import mlx.core as mx
 import mlx.nn as nn
 
-from .base import BaseModelArgs
+from .base import BaseModelArgs, KVCache, fuse_linears
+from .layers import RoPE, blockwise_attention
 
 
 @dataclass
@@ -21,12 +22,13 @@ class ModelArgs(BaseModelArgs):
     num_key_value_heads: int = None
     rope_theta: float = 10000
     rope_traditional: bool = False
+    attention_block_size: Optional[int] = None
 
 
 @partial(mx.compile, shapeless=True)
-def rms_norm(x, weight, eps):
+def rms_norm(x, weight, eps, scale=1.0):
     x = x.astype(mx.float32)
-    x = x * mx.rsqrt(x.square().mean(-1, keepdims=True) + eps)
+    x = x * (mx.rsqrt(x.square().mean(-1, keepdims=True) + eps) * scale)
     return (1.0 + weight) * x.astype(weight.dtype)
 
 
@@ -35,9 +37,10 @@ class RMSNorm(nn.Module):
         super().__init__()
         self.weight = mx.ones((dims,))
         self.eps = eps
+        self.scale = 1.0
 
     def __call__(self, x):
-        return rms_norm(x, self.weight, self.eps)
+        return rms_norm(x, self.weight, self.eps, self.scale)
 
 
 class Attention(nn.Module):
@@ -52,13 +55,15 @@ class Attention(nn.Module):
         self.repeats = n_heads // n_kv_heads
 
         self.scale = head_dim**-0.5
+        # attend to the keys in blocks of this size during prefill
+        self.block_size = args.attention_block_size
 
         self.q_proj = nn.Linear(dim, n_heads * head_dim, bias=False)
         self.k_proj = nn.Linear(dim, n_kv_heads * head_dim, bias=False)
         self.v_proj = nn.Linear(dim, n_kv_heads * head_dim, bias=False)
         self.o_proj = nn.Linear(n_heads * head_dim, dim, bias=False)
 
-        self.rope = nn.RoPE(
+        self.rope = RoPE(
             head_dim,
             traditional=args.rope_traditional,
             base=args.rope_theta,
@@ -68,37 +73,59 @@ class Attention(nn.Module):
         self,
         x: mx.array,
         mask: Optional[mx.array] = None,
-        cache: Optional[Tuple[mx.array, mx.array]] = None,
+        cache: Optional[KVCache] = None,
     ) -> mx.array:
         B, L, D = x.shape
 
-        queries, keys, values = self.q_proj(x), self.k_proj(x), self.v_proj(x)
+        if "qkv_proj" in self:
+            q_dims = self.n_heads * self.head_dim
+            kv_dims = self.n_kv_heads * self.head_dim
+            queries, keys, values = mx.split(
+                self.qkv_proj(x), [q_dims, q_dims + kv_dims], axis=-1)
+        else:
+            queries, keys, values = self.q_proj(x), self.k_proj(x), self.v_proj(x)
 
         # Prepare the queries, keys and values for the attention computation
         queries = queries.reshape(B, L, self.n_heads, -1).transpose(0, 2, 1, 3)
         keys = keys.reshape(B, L, self.n_kv_heads, -1).transpose(0, 2, 1, 3)
         values = values.reshape(B, L, self.n_kv_heads, -1).transpose(0, 2, 1, 3)
 
-        if self.repeats > 1:
-            keys = mx.repeat(keys, self.repeats, axis=1)
-            values = mx.repeat(values, self.repeats, axis=1)
-
         if cache is not None:
-            key_cache, value_cache = cache
-            queries = self.rope(queries, offset=key_cache.shape[2])
-            keys = self.rope(keys, offset=key_cache.shape[2])
-            keys = mx.concatenate([key_cache, keys], axis=2)
-            values = mx.concatenate([value_cache, values], axis=2)
+            queries = self.rope(queries, offset=cache.offset)
+            keys = self.rope(keys, offset=cache.offset)
+            keys, values = cache.update_and_fetch(keys, values)
         else:
             queries = self.rope(queries)
             keys = self.rope(keys)
 
-        scores = (queries * self.scale) @ keys.transpose(0, 1, 3, 2)
-        if mask is not None:
-            scores += mask
-        scores = mx.softmax(scores.astype(mx.float32), axis=-1).astype(scores.dtype)
-        output = (scores @ values).transpose(0, 2, 1, 3).reshape(B, L, -1)
-        return self.o_proj(output), (keys, values)
+        if self.repeats > 1:
+            # broadcast the shared kv heads over their query group instead of
+            # caching `repeats` copies of them
+            queries = queries.reshape(B, self.n_kv_heads, self.repeats, L, -1)
+            keys, values = keys[:, :, None], values[:, :, None]
+            if mask is not None and mask.ndim == 4:
+                mask = mask[:, :, None]
+
+        if self.block_size is not None and L > 1:
+            output = blockwise_attention(
+                queries, keys, values, self.scale, mask, self.block_size)
+        else:
+            scores = (queries * self.scale) @ keys.swapaxes(-1, -2)
+            if mask is not None:
+                scores += mask
+            scores = mx.softmax(scores.astype(mx.float32), axis=-1).astype(scores.dtype)
+            output = scores @ values
+        output = output.reshape(B, self.n_heads, L, -1)
+        output = output.transpose(0, 2, 1, 3).reshape(B, L, -1)
+        return self.o_proj(output), cache
+
+    def fuse(self):
+        """
+        Replace the query, key and value projections by a single one.
+        """
+        self.qkv_proj = fuse_linears([self.q_proj, self.k_proj, self.v_proj])
+        for name in ("q_proj", "k_proj", "v_proj"):
+            del self[name]
 
 
 class MLP(nn.Module):
@@ -109,7 +136,19 @@ class MLP(nn.Module):
         self.up_proj = nn.Linear(dim, hidden_dim, bias=False)
 
     def __call__(self, x) -> mx.array:
-        return self.down_proj(nn.gelu(self.gate_proj(x)) * self.up_proj(x))
+        if "gate_up_proj" in self:
+            gate, up = mx.split(self.gate_up_proj(x), 2, axis=-1)
+        else:
+            gate, up = self.gate_proj(x), self.up_proj(x)
+        return self.down_proj(nn.gelu(gate) * up)
+
+    def fuse(self):
+        """
+        Replace the gate and up projections by a single one.
+        """
+        self.gate_up_proj = fuse_linears([self.gate_proj, self.up_proj])
+        del self["gate_proj"]
+        del self["up_proj"]
 
 
 class TransformerBlock(nn.Module):
@@ -127,7 +166,7 @@ class TransformerBlock(nn.Module):
         self,
         x: mx.array,
         mask: Optional[mx.array] = None,
-        cache: Optional[Tuple[mx.array, mx.array]] = None,
+        cache: Optional[KVCache] = None,
     ) -> mx.array:
         r, cache = self.self_attn(self.input_layernorm(x), mask, cache)
         h = x + r
@@ -148,22 +187,23 @@ class GemmaModel(nn.Module):
             TransformerBlock(args=args) for _ in range(args.num_hidden_layers)
         ]
         self.norm = RMSNorm(args.hidden_size, eps=args.rms_norm_eps)
+        self.embed_scale = args.hidden_size**0.5
 
     def __call__(
         self,
         inputs: mx.array,
         cache=None,
+        mask: Optional[mx.array] = None,
     ):
         h = self.embed_tokens(inputs)
-        h = h * (self.args.hidden_size**0.5)
-
-        mask = None
-        if h.shape[1] > 1:
-            mask = nn.MultiHeadAttention.create_additive_causal_mask(h.shape[1])
-            mask = mask.astype(h.dtype)
+        if self.embed_scale != 1.0:
+            h = h * self.embed_scale
 
         if cache is None:
-            cache = [None] * len(self.layers)
+            cache = [KVCache() for _ in self.layers]
+
+        if mask is None and h.shape[1] > 1:
+            mask = cache[0].make_mask(h.shape[1], h.dtype)
 
         for e, layer in enumerate(self.layers):
             h, cache[e] = layer(h, mask, cache[e])
@@ -181,11 +221,46 @@ class Model(nn.Module):
         self,
         inputs: mx.array,
         cache=None,
+        mask: Optional[mx.array] = None,
+        num_logits: Optional[int] = None,
     ):
-        out, cache = self.model(inputs, cache)
+        out, cache = self.model(inputs, cache, mask)
+        # only project the positions that are going to be sampled
+        if num_logits is not None:
+            out = out[:, -num_logits:, :]
         out = out @ self.model.embed_tokens.weight.T
         return out, cache
 
+    def fuse(self):
+        """
+        Fuse the projections of each layer which share their input, and
+        fold the embedding scale into the embedding.
+
+        The embedding is tied to the output projection, so the final norm
+        undoes the scale before it.
+        """
+        # load_model only quantizes linears, the packed weights of a
+        # quantized embedding could not be scaled
+        assert "scales" not in self.model.embed_tokens, \
+            "cannot fold the embedding scale into a quantized embedding"
+
+        for layer in self.layers:
+            layer.self_attn.fuse()
+            layer.mlp.fuse()
+
+        embed_tokens = self.model.embed_tokens
+        embed_tokens.weight = embed_tokens.weight * self.model.embed_scale
+        self.model.norm.scale = 1 / self.model.embed_scale
+        self.model.embed_scale = 1.0
+
     @property
     def layers(self):
         return self.model.layers
+
+    @property
+    def vocab_size(self) -> int:
+        return self.model.vocab_size
+
+    @property
+    def sliding_window(self) -> Optional[int]:
+        return None
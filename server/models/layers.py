@@ -1,4 +1,6 @@
-from functools import partial
+import math
+from functools import lru_cache, partial
+from typing import Optional, Tuple
 
 import mlx.core as mx
 import mlx.nn as nn
@@ -49,3 +51,103 @@ class LayerNorm(nn.Module):
             return ln_norm(x, self.eps, self.weight, self.bias)
         else:
             return ln_norm(x, self.eps)
+
+
+# the fused kernel computes the rotation angles itself
+_FAST_ROPE = hasattr(mx, "fast") and hasattr(mx.fast, "rope")
+
+
+@lru_cache(maxsize=8)
+def _rope_table(
+    size: int, dims: int, base: float, scale: float, dtype: mx.Dtype
+) -> Tuple[mx.array, mx.array]:
+    positions = mx.arange(size, dtype=mx.float32) * scale
+    freqs = mx.exp(-mx.arange(dims // 2, dtype=mx.float32) * (math.log(base) / (dims // 2)))
+    theta = positions[:, None] * freqs[None]
+    return mx.cos(theta).astype(dtype), mx.sin(theta).astype(dtype)
+
+
+class RoPE(nn.RoPE):
+    """
+    Rotary positional encoding reading its angles from a shared table.
+
+    Without the fused `mx.fast.rope` kernel the cos/sin of the positions
+    would be recomputed on every call. They are instead computed once for a
+    table of positions, grown by doubling and shared by all the layers, and
+    each call slices its positions out of it.
+    """
+
+    def __call__(self, x: mx.array, offset: int = 0) -> mx.array:
+        if _FAST_ROPE or not isinstance(offset, int) or offset < 0:
+            return super().__call__(x, offset=offset)
+
+        N = x.shape[-2]
+        size = max(1024, 1 << (offset + N - 1).bit_length())
+        cos, sin = _rope_table(size, self.dims, self.base, self.scale, x.dtype)
+        cos, sin = cos[offset:offset + N], sin[offset:offset + N]
+
+        if self.traditional:
+            x1, x2 = x[..., :self.dims:2], x[..., 1:self.dims:2]
+            rx = mx.stack([x1 * cos - x2 * sin, x1 * sin + x2 * cos], axis=-1)
+            rx = rx.reshape(*x.shape[:-1], self.dims)
+        else:
+            half = self.dims // 2
+            x1, x2 = x[..., :half], x[..., half:self.dims]
+            rx = mx.concatenate([x1 * cos - x2 * sin, x1 * sin + x2 * cos], axis=-1)
+        if self.dims < x.shape[-1]:
+            rx = mx.concatenate([rx, x[..., self.dims:]], axis=-1)
+        return rx
+
+
+def blockwise_attention(
+    queries: mx.array,
+    keys: mx.array,
+    values: mx.array,
+    scale: float,
+    mask: Optional[mx.array] = None,
+    block_size: int = 512,
+) -> mx.array:
+    """
+    Scaled dot product attention over blocks of `block_size` keys.
+
+    The softmax is computed online: the running maximum and sum of the
+    exponentiated scores of each query are kept in float32, and the output
+    accumulated so far is rescaled whenever the maximum grows. Only the
+    scores of one block are materialized at a time, so memory grows
+    linearly with the number of keys instead of with the full score matrix.
+
+    Args:
+        queries (mx.array): Queries of shape (..., L, D).
+        keys (mx.array): Keys of shape (..., S, D), broadcastable to the queries.
+        values (mx.array): Values of shape (..., S, D_v).
+        scale (float): Scale of the scores.
+        mask (mx.array, optional): Additive mask broadcastable to (..., L, S).
+        block_size (int): Number of keys per block.
+
+    Returns:
+        mx.array: The attention output of shape (..., L, D_v).
+    """
+    queries = queries * scale
+    running_max = total = output = None
+    for start in range(0, keys.shape[-2], block_size):
+        k = keys[..., start:start + block_size, :]
+        v = values[..., start:start + block_size, :]
+        scores = (queries @ k.swapaxes(-1, -2)).astype(mx.float32)
+        if mask is not None:
+            scores = scores + mask[..., start:start + block_size]
+
+        block_max = mx.max(scores, axis=-1, keepdims=True)
+        new_max = block_max if running_max is None else mx.maximum(running_max, block_max)
+        # rows without any unmasked key so far must not become nan
+        shift = mx.where(new_max == -float("inf"), 0.0, new_max)
+        probs = mx.exp(scores - shift)
+        block_output = (probs.astype(v.dtype) @ v).astype(mx.float32)
+        if running_max is None:
+            total = probs.sum(axis=-1, keepdims=True)
+            output = block_output
+        else:
+            correction = mx.exp(running_max - shift)
+            total = total * correction + probs.sum(axis=-1, keepdims=True)
+            output = output * correction + block_output
+        running_max = new_max
+    return (output / total).astype(queries.dtype)
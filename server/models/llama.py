@@ -1,11 +1,11 @@
 from dataclasses import dataclass
-from typing import Dict, Optional, Tuple, Union
+from typing import Dict, Optional, Union
 
 import mlx.core as mx
 import mlx.nn as nn
 
-from .base import BaseModelArgs
-from .layers import RMSNorm
+from .base import BaseModelArgs, KVCache, fuse_linears
+from .layers import RMSNorm, RoPE, blockwise_attention
 
 
 @dataclass
@@ -21,6 +21,8 @@ class ModelArgs(BaseModelArgs):
     rope_theta: float = 10000
     rope_traditional: bool = False
     rope_scaling: Optional[Dict[str, Union[float, str]]] = None
+    sliding_window: Optional[int] = None
+    attention_block_size: Optional[int] = None
 
     def __post_init__(self):
         if self.num_key_value_heads is None:
@@ -45,8 +47,10 @@ class Attention(nn.Module):
 
         self.repeats = n_heads // n_kv_heads
 
-        head_dim = args.hidden_size // n_heads
+        self.head_dim = head_dim = args.hidden_size // n_heads
         self.scale = head_dim**-0.5
+        # attend to the keys in blocks of this size during prefill
+        self.block_size = args.attention_block_size
 
         self.q_proj = nn.Linear(dim, n_heads * head_dim, bias=False)
         self.k_proj = nn.Linear(dim, n_kv_heads * head_dim, bias=False)
@@ -58,7 +62,7 @@ class Attention(nn.Module):
             if args.rope_scaling is not None and args.rope_scaling["type"] == "linear"
             else 1
         )
-        self.rope = nn.RoPE(
+        self.rope = RoPE(
             head_dim,
             traditional=args.rope_traditional,
             base=args.rope_theta,
@@ -69,37 +73,59 @@ class Attention(nn.Module):
         self,
         x: mx.array,
         mask: Optional[mx.array] = None,
-        cache: Optional[Tuple[mx.array, mx.array]] = None,
+        cache: Optional[KVCache] = None,
     ) -> mx.array:
         B, L, D = x.shape
 
-        queries, keys, values = self.q_proj(x), self.k_proj(x), self.v_proj(x)
+        if "qkv_proj" in self:
+            q_dims = self.n_heads * self.head_dim
+            kv_dims = self.n_kv_heads * self.head_dim
+            queries, keys, values = mx.split(
+                self.qkv_proj(x), [q_dims, q_dims + kv_dims], axis=-1)
+        else:
+            queries, keys, values = self.q_proj(x), self.k_proj(x), self.v_proj(x)
 
         # Prepare the queries, keys and values for the attention computation
         queries = queries.reshape(B, L, self.n_heads, -1).transpose(0, 2, 1, 3)
         keys = keys.reshape(B, L, self.n_kv_heads, -1).transpose(0, 2, 1, 3)
         values = values.reshape(B, L, self.n_kv_heads, -1).transpose(0, 2, 1, 3)
 
-        if self.repeats > 1:
-            keys = mx.repeat(keys, self.repeats, axis=1)
-            values = mx.repeat(values, self.repeats, axis=1)
-
         if cache is not None:
-            key_cache, value_cache = cache
-            queries = self.rope(queries, offset=key_cache.shape[2])
-            keys = self.rope(keys, offset=key_cache.shape[2])
-            keys = mx.concatenate([key_cache, keys], axis=2)
-            values = mx.concatenate([value_cache, values], axis=2)
+            queries = self.rope(queries, offset=cache.offset)
+            keys = self.rope(keys, offset=cache.offset)
+            keys, values = cache.update_and_fetch(keys, values)
         else:
             queries = self.rope(queries)
             keys = self.rope(keys)
 
-        scores = (queries * self.scale) @ keys.transpose(0, 1, 3, 2)
-        if mask is not None:
-            scores += mask
-        scores = mx.softmax(scores.astype(mx.float32), axis=-1).astype(scores.dtype)
-        output = (scores @ values).transpose(0, 2, 1, 3).reshape(B, L, -1)
-        return self.o_proj(output), (keys, values)
+        if self.repeats > 1:
+            # broadcast the shared kv heads over their query group instead of
+            # caching `repeats` copies of them
+            queries = queries.reshape(B, self.n_kv_heads, self.repeats, L, -1)
+            keys, values = keys[:, :, None], values[:, :, None]
+            if mask is not None and mask.ndim == 4:
+                mask = mask[:, :, None]
+
+        if self.block_size is not None and L > 1:
+            output = blockwise_attention(
+                queries, keys, values, self.scale, mask, self.block_size)
+        else:
+            scores = (queries * self.scale) @ keys.swapaxes(-1, -2)
+            if mask is not None:
+                scores += mask
+            scores = mx.softmax(scores.astype(mx.float32), axis=-1).astype(scores.dtype)
+            output = scores @ values
+        output = output.reshape(B, self.n_heads, L, -1)
+        output = output.transpose(0, 2, 1, 3).reshape(B, L, -1)
+        return self.o_proj(output), cache
+
+    def fuse(self):
+        """
+        Replace the query, key and value projections by a single one.
+        """
+        self.qkv_proj = fuse_linears([self.q_proj, self.k_proj, self.v_proj])
+        for name in ("q_proj", "k_proj", "v_proj"):
+            del self[name]
 
 
 class MLP(nn.Module):
@@ -110,7 +136,19 @@ class MLP(nn.Module):
         self.up_proj = nn.Linear(dim, hidden_dim, bias=False)
 
     def __call__(self, x) -> mx.array:
-        return self.down_proj(nn.silu(self.gate_proj(x)) * self.up_proj(x))
+        if "gate_up_proj" in self:
+            gate, up = mx.split(self.gate_up_proj(x), 2, axis=-1)
+        else:
+            gate, up = self.gate_proj(x), self.up_proj(x)
+        return self.down_proj(nn.silu(gate) * up)
+
+    def fuse(self):
+        """
+        Replace the gate and up projections by a single one.
+        """
+        self.gate_up_proj = fuse_linears([self.gate_proj, self.up_proj])
+        del self["gate_proj"]
+        del self["up_proj"]
 
 
 class TransformerBlock(nn.Module):
@@ -128,7 +166,7 @@ class TransformerBlock(nn.Module):
         self,
         x: mx.array,
         mask: Optional[mx.array] = None,
-        cache: Optional[Tuple[mx.array, mx.array]] = None,
+        cache: Optional[KVCache] = None,
     ) -> mx.array:
         r, cache = self.self_attn(self.input_layernorm(x), mask, cache)
         h = x + r
@@ -154,16 +192,15 @@ class LlamaModel(nn.Module):
         self,
         inputs: mx.array,
         cache=None,
+        mask: Optional[mx.array] = None,
     ):
         h = self.embed_tokens(inputs)
 
-        mask = None
-        if h.shape[1] > 1:
-            mask = nn.MultiHeadAttention.create_additive_causal_mask(h.shape[1])
-            mask = mask.astype(h.dtype)
-
         if cache is None:
-            cache = [None] * len(self.layers)
+            cache = [KVCache() for _ in self.layers]
+
+        if mask is None and h.shape[1] > 1:
+            mask = cache[0].make_mask(h.shape[1], h.dtype)
 
         for e, layer in enumerate(self.layers):
             h, cache[e] = layer(h, mask, cache[e])
@@ -182,8 +219,13 @@ class Model(nn.Module):
         self,
         inputs: mx.array,
         cache=None,
+        mask: Optional[mx.array] = None,
+        num_logits: Optional[int] = None,
     ):
-        out, cache = self.model(inputs, cache)
+        out, cache = self.model(inputs, cache, mask)
+        # only project the positions that are going to be sampled
+        if num_logits is not None:
+            out = out[:, -num_logits:, :]
         return self.lm_head(out), cache
 
     @staticmethod
@@ -193,6 +235,22 @@ class Model(nn.Module):
             k: v for k, v in weights.items() if "self_attn.rotary_emb.inv_freq" not in k
         }
 
+    def fuse(self):
+        """
+        Fuse the projections of each layer which share their input.
+        """
+        for layer in self.layers:
+            layer.self_attn.fuse()
+            layer.mlp.fuse()
+
     @property
     def layers(self):
         return self.model.layers
+
+    @property
+    def vocab_size(self) -> int:
+        return self.model.vocab_size
+
+    @property
+    def sliding_window(self) -> Optional[int]:
+        return self.model.args.sliding_window
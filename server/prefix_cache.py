@@ -0,0 +1,125 @@
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+import mlx.core as mx
+from mlx.utils import tree_flatten, tree_map
+
+from .models.base import KVCache
+
+
+class _Node:
+    __slots__ = ('key', 'parent', 'children', 'blocks', 'nbytes', 'last_used')
+
+    def __init__(self, key=None, parent=None, blocks=None):
+        self.key: Optional[Tuple[int, ...]] = key
+        self.parent: Optional['_Node'] = parent
+        self.children: Dict[Tuple[int, ...], '_Node'] = {}
+        self.blocks: Optional[List[Tuple]] = blocks
+        self.nbytes = sum(x.nbytes for _, x in tree_flatten(blocks)) if blocks else 0
+        self.last_used = 0
+
+
+class PrefixCache:
+    """
+    Radix tree of prompt token ids to their KV cache blocks.
+
+    Each edge is one block of `block_size` token ids and each node stores
+    the per-layer keys/values of that block, so prompts sharing a prefix
+    (chat template, system scaffold, earlier turns) share the cached
+    blocks. Only whole blocks are reused and the least recently used
+    leaves are evicted once the blocks take more than `max_bytes`.
+
+    Args:
+        block_size (int): Number of tokens per cached block.
+        max_bytes (int): Maximum memory of the blocks kept across all
+            prompts, 256 MB by default.
+    """
+
+    def __init__(self, block_size: int = 64, max_bytes: int = 256 * 2**20):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self._root = _Node()
+        self._nbytes = 0
+        self._clock = itertools.count(1)
+
+    def fetch(self, tokens: List[int], cache: List[KVCache]) -> int:
+        """
+        Load the longest cached block prefix of `tokens` into `cache`.
+
+        At least one token is always left uncached so the caller has
+        something to feed the model for the next logits.
+
+        Args:
+            tokens (List[int]): The prompt token ids.
+            cache (List[KVCache]): Empty per-layer caches to fill.
+
+        Returns:
+            int: The number of prefix tokens loaded into `cache`.
+        """
+        bs = self.block_size
+        node, blocks = self._root, []
+        for i in range((len(tokens) - 1) // bs):
+            node = node.children.get(tuple(tokens[i * bs:(i + 1) * bs]))
+            if node is None:
+                break
+            node.last_used = next(self._clock)
+            blocks.append(node.blocks)
+
+        if not blocks:
+            return 0
+
+        for c, layer in zip(cache, zip(*blocks)):
+            c.raw_state = tree_map(lambda *x: mx.concatenate(x, axis=2), *layer)
+        return len(blocks) * bs
+
+    def insert(self, tokens: List[int], cache: List[KVCache]):
+        """
+        Store the whole blocks of `tokens` whose keys/values are in `cache`.
+        """
+        if cache[0].size < cache[0].offset:
+            # positions were evicted, the cached ones no longer line up
+            # with the tokens
+            return
+
+        bs = self.block_size
+        node = self._root
+        for i in range(min(len(tokens), cache[0].offset) // bs):
+            key = tuple(tokens[i * bs:(i + 1) * bs])
+            child = node.children.get(key)
+            if child is None:
+                # copy so the blocks don't pin the live cache buffers
+                # keep the stored format, e.g. the quantized keys/values
+                # of a QuantizedKVCache, so restoring needs no conversion
+                blocks = [
+                    tree_map(lambda x: mx.array(x[..., i * bs:(i + 1) * bs, :]), c.raw_state)
+                    for c in cache
+                ]
+                mx.eval(blocks)
+                child = _Node(key, node, blocks)
+                node.children[key] = child
+                self._nbytes += child.nbytes
+            child.last_used = next(self._clock)
+            node = child
+
+        self._evict()
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes:
+            leaves = [n for n in self._nodes() if not n.children]
+            lru = min(leaves, key=lambda n: n.last_used)
+            del lru.parent.children[lru.key]
+            self._nbytes -= lru.nbytes
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory of the cached blocks.
+        """
+        return self._nbytes
+
+    def _nodes(self):
+        stack = list(self._root.children.values())
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            yield node
@@ -0,0 +1,124 @@
+import math
+from typing import Tuple
+
+import mlx.core as mx
+
+
+def apply_top_k(logits: mx.array, top_k: int) -> mx.array:
+    """
+    Mask all but the `top_k` largest logits.
+
+    Args:
+        logits (mx.array): Logits of shape (1, vocab_size).
+        top_k (int): Number of logits kept.
+
+    Returns:
+        mx.array: The logits with the others set to -inf.
+    """
+    if top_k >= logits.shape[-1]:
+        return logits
+    # a partition only places the k-th largest, nothing is fully sorted
+    kth = -mx.partition(-logits, top_k - 1, axis=-1)[..., top_k - 1:top_k]
+    return mx.where(logits >= kth, logits, -float("inf"))
+
+
+def apply_min_p(logits: mx.array, min_p: float) -> mx.array:
+    """
+    Mask the logits whose probability is below `min_p` times the largest.
+
+    Args:
+        logits (mx.array): Logits of shape (1, vocab_size).
+        min_p (float): Minimum probability relative to the most likely token.
+
+    Returns:
+        mx.array: The logits with the unlikely ones set to -inf.
+    """
+    # compared in log space, so no softmax is needed
+    threshold = mx.max(logits, axis=-1, keepdims=True) + math.log(min_p)
+    return mx.where(logits >= threshold, logits, -float("inf"))
+
+
+def sample_top_p(
+    logits: mx.array, top_p: float, max_candidates: int = 1024
+) -> mx.array:
+    """
+    Sample from the smallest set of tokens whose probability reaches `top_p`.
+
+    Only the `max_candidates` largest logits are selected with a partition
+    and sorted, the nucleus is truncated to them when the vocabulary's tail
+    would be needed to reach `top_p`.
+
+    Args:
+        logits (mx.array): Logits of shape (1, vocab_size).
+        top_p (float): Nucleus sampling threshold.
+        max_candidates (int): Bound on the nucleus size.
+
+    Returns:
+        mx.array: The sampled token of shape (1,).
+    """
+    if logits.dtype == mx.bfloat16:
+        # workaround for unable to load kernel contiguous_scan_inclusive_sum_bfloat16_bfloat16
+        logits = logits.astype(mx.float32)
+
+    if max_candidates < logits.shape[-1]:
+        indices = mx.argpartition(-logits, max_candidates - 1, axis=-1)[..., :max_candidates]
+        candidates = mx.take_along_axis(logits, indices, axis=-1)
+    else:
+        indices = mx.broadcast_to(mx.arange(logits.shape[-1]), logits.shape)
+        candidates = logits
+    order = mx.argsort(-candidates, axis=-1)
+    indices = mx.take_along_axis(indices, order, axis=-1)
+    candidates = mx.take_along_axis(candidates, order, axis=-1)
+
+    probs = mx.exp(candidates - mx.logsumexp(logits, axis=-1, keepdims=True))
+    # keep a token while the mass before it is below top_p, so at least one is kept
+    exclusive = mx.cumsum(probs, axis=-1) - probs
+    candidates = mx.where(exclusive < top_p, candidates, -float("inf"))
+    choice = mx.random.categorical(candidates)
+    return mx.take_along_axis(indices, choice[:, None], axis=-1)[:, 0]
+
+
+def sample(
+    logits: mx.array,
+    temp: float,
+    top_p: float = 1.0,
+    top_k: int = 0,
+    min_p: float = 0.0,
+) -> Tuple[mx.array, mx.array]:
+    """
+    Sample a token from the last-position logits.
+
+    The filters are applied to the tempered logits in the order top-k,
+    min-p, top-p. The returned probability is a lazy array, it is only
+    computed if the caller evaluates it.
+
+    Args:
+        logits (mx.array): Logits of shape (1, vocab_size).
+        temp (float): The temperature for sampling, if 0 the argmax is used.
+        top_p (float): Nucleus sampling threshold, disabled at 1.0.
+        top_k (int): Only sample from the `top_k` most likely tokens,
+            disabled at 0.
+        min_p (float): Only sample tokens at least `min_p` times as likely
+            as the most likely one, disabled at 0.0.
+
+    Returns:
+        Tuple[mx.array, mx.array]: The sampled token and its probability.
+    """
+    if temp == 0:
+        token = mx.argmax(logits, axis=-1)
+    else:
+        scaled = logits * (1 / temp)
+        if top_k > 0:
+            scaled = apply_top_k(scaled, top_k)
+        if min_p > 0.0:
+            scaled = apply_min_p(scaled, min_p)
+        if 0 < top_p < 1.0:
+            token = sample_top_p(scaled, top_p)
+        else:
+            token = mx.random.categorical(scaled)
+
+    prob = mx.exp(
+        mx.take_along_axis(logits, token[:, None], axis=-1)[:, 0]
+        - mx.logsumexp(logits, axis=-1)
+    )
+    return token, prob
@@ -0,0 +1,654 @@
+import queue
+import threading
+from dataclasses import dataclass, field, replace
+from typing import Any, Iterator, List, Optional, Tuple
+
+import mlx.core as mx
+import mlx.nn as nn
+
+from .constrained import Constraint
+from .models.base import KVCache, RotatingKVCache, make_kv_cache
+from .prefix_cache import PrefixCache
+from .utils import (
+    DraftModel,
+    PenaltyContext,
+    PromptLookup,
+    SpeculativeStats,
+    async_eval,
+)
+from .sampler import sample
+
+
+@dataclass
+class Request:
+    prompt: mx.array
+    max_tokens: int
+    eos_token_id: Optional[int]
+    temp: float = 0.0
+    repetition_penalty: Optional[float] = None
+    repetition_context_size: Optional[int] = 20
+    top_p: float = 1.0
+    top_k: int = 0
+    min_p: float = 0.0
+    presence_penalty: float = 0.0
+    frequency_penalty: float = 0.0
+    num_draft_tokens: int = 0
+    logprobs: bool = False
+    top_logprobs: int = 0
+    constraint: Optional[Constraint] = None
+    tokens: queue.Queue = field(default_factory=queue.Queue)
+    penalty: Optional[PenaltyContext] = None
+    num_tokens: int = 0
+    cached_tokens: int = 0
+    drafter: Any = None
+    stats: SpeculativeStats = field(default_factory=SpeculativeStats)
+    cancelled: bool = False
+    done: bool = False
+    forks: List["Request"] = field(default_factory=list)
+    # per sampled token, its log probability and the top alternatives' ids
+    # and log probabilities, kept on the device until the request finishes
+    device_logprobs: List[Tuple[mx.array, mx.array, mx.array]] = field(
+        default_factory=list)
+    token_logprobs: Optional[List[Tuple[float, List[Tuple[int, float]]]]] = None
+
+    @property
+    def samples(self) -> List["Request"]:
+        """
+        The request and its forks, sampled from the same prefilled prompt.
+        """
+        return [self] + self.forks
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Yield generated token ids as they are decoded, closing the iterator
+        early cancels the request.
+        """
+        try:
+            while True:
+                token = self.tokens.get()
+                self.done = token is None or isinstance(token, Exception)
+                if token is None:
+                    return
+                if isinstance(token, Exception):
+                    raise token
+                yield token
+        finally:
+            self.cancelled = True
+
+    def wait(self):
+        """
+        Wait until the request is finished, e.g. after cancelling it, so its
+        `token_logprobs` are set.
+        """
+        while not self.done:
+            token = self.tokens.get()
+            self.done = token is None or isinstance(token, Exception)
+
+
+class BatchScheduler:
+    """
+    Continuous batching over a decoder model.
+
+    A single worker thread owns the model. Every step it prefills the next
+    chunk of a pending request (joined into the running batch once its
+    prompt is done), advances all active requests by one token in a single
+    batched forward pass and retires the finished ones, so concurrent
+    clients share decode steps instead of queueing behind each other.
+
+    Decoding is pipelined: a step queues the next forward pass on the
+    sampled tokens before reading them back, so the host hands out tokens
+    and builds the next graph while the device evaluates.
+
+    Rows are left padded to a common cache length, after the attention
+    sinks of a bounded cache. Padded positions are masked out and the
+    cached keys of a shifted row are re-rotated so RoPE distances are
+    unchanged.
+
+    A request asking for `num_draft_tokens` is decoded speculatively while
+    it is the only active one, drafting with `draft_model` if given and
+    prompt lookup otherwise.
+
+    Args:
+        model (nn.Module): The decoder model (llama or gemma).
+        max_batch_size (int): Maximum number of requests decoded together.
+        prefix_cache (PrefixCache, optional): Cache of prompt prefixes
+            consulted before each prefill.
+        prefill_step_size (int): Number of prompt tokens prefilled per step,
+            decode steps of the running batch run between the chunks.
+        draft_model (nn.Module, optional): Small model sharing the tokenizer
+            used to draft tokens for speculative decoding.
+        kv_bits (int, optional): Quantize the KV cache to this many bits.
+        kv_group_size (int): Group size of the KV cache quantization.
+        max_kv_size (int, optional): Bound the KV cache of every request to
+            this many positions, the model's sliding window is used if it
+            has one.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        max_batch_size: int = 8,
+        prefix_cache: Optional[PrefixCache] = None,
+        prefill_step_size: int = 512,
+        draft_model: Optional[nn.Module] = None,
+        kv_bits: Optional[int] = None,
+        kv_group_size: int = 64,
+        max_kv_size: Optional[int] = None,
+    ):
+        if kv_bits is not None and (max_kv_size or model.sliding_window):
+            raise ValueError("kv_bits is not supported with a bounded KV cache")
+        if draft_model is not None and draft_model.vocab_size != model.vocab_size:
+            raise ValueError(
+                f"The draft model's vocab_size {draft_model.vocab_size} "
+                f"doesn't match the model's {model.vocab_size}")
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.prefill_step_size = prefill_step_size
+        self.draft_model = draft_model
+        self.kv_bits = kv_bits
+        self.kv_group_size = kv_group_size
+        self.max_kv_size = max_kv_size
+
+        self._pending = queue.Queue()
+        # a request whose samples don't fit in the batch yet
+        self._waiting: Optional[Request] = None
+        self._prefilling = None
+        self._active: List[Request] = []
+        self._pads: List[int] = []
+        self._cache = None
+        self._y = None
+        self._running = True
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt: mx.array,
+        max_tokens: int,
+        eos_token_id: Optional[int],
+        temp: float = 0.0,
+        repetition_penalty: Optional[float] = None,
+        repetition_context_size: Optional[int] = 20,
+        top_p: float = 1.0,
+        num_draft_tokens: int = 0,
+        presence_penalty: float = 0.0,
+        frequency_penalty: float = 0.0,
+        top_k: int = 0,
+        min_p: float = 0.0,
+        n: int = 1,
+        logprobs: bool = False,
+        top_logprobs: int = 0,
+        constraint: Optional[Constraint] = None,
+    ) -> Request:
+        """
+        Queue a prompt for generation.
+
+        Iterate the returned request for its token ids. Generation stops on
+        `eos_token_id` (not yielded) or after `max_tokens`. With `n` > 1 the
+        other samples are the request's `forks`, they share its prefill and
+        decode without speculation. With `logprobs` the log probabilities of
+        the tokens and of their `top_logprobs` most likely alternatives are
+        read back once the request is finished, see `Request.wait`. A
+        `constraint` restricts the tokens of every sample to a regular
+        expression or JSON schema, such requests decode without speculation.
+        """
+        if repetition_penalty and (
+            repetition_penalty < 0 or not isinstance(repetition_penalty, float)
+        ):
+            raise ValueError(
+                f"repetition_penalty must be a non-negative float, got {repetition_penalty}"
+            )
+        if not 1 <= n <= self.max_batch_size:
+            raise ValueError(
+                f"n must be between 1 and {self.max_batch_size}, got {n}")
+
+        request = Request(
+            prompt=prompt,
+            max_tokens=max_tokens,
+            eos_token_id=eos_token_id,
+            temp=temp,
+            repetition_penalty=repetition_penalty,
+            repetition_context_size=repetition_context_size,
+            top_p=top_p,
+            top_k=top_k,
+            min_p=min_p,
+            presence_penalty=presence_penalty,
+            frequency_penalty=frequency_penalty,
+            num_draft_tokens=num_draft_tokens if constraint is None else 0,
+            logprobs=logprobs,
+            top_logprobs=top_logprobs if logprobs else 0,
+            constraint=constraint,
+        )
+        request.forks = [
+            replace(request, tokens=queue.Queue(), stats=SpeculativeStats(),
+                    num_draft_tokens=0, device_logprobs=[],
+                    constraint=constraint and constraint.copy())
+            for _ in range(n - 1)
+        ]
+        self._pending.put(request)
+        return request
+
+    def stop(self):
+        self._running = False
+        self._pending.put(None)
+
+    def _run(self):
+        while self._running:
+            self._admit()
+            if self._prefilling is not None:
+                self._prefill()
+            if not self._active:
+                continue
+            try:
+                self._step()
+            except Exception as e:
+                for request in self._active:
+                    request.tokens.put(e)
+                self._reset()
+
+        if self._prefilling is not None:
+            for request in self._prefilling[0].samples:
+                request.tokens.put(None)
+        for request in self._active:
+            request.tokens.put(None)
+        if self._waiting is not None:
+            for r in self._waiting.samples:
+                r.tokens.put(None)
+        while not self._pending.empty():
+            request = self._pending.get()
+            if request is not None:
+                for r in request.samples:
+                    r.tokens.put(None)
+
+    def _admit(self):
+        if self._prefilling is not None or len(self._active) >= self.max_batch_size:
+            return
+        while True:
+            if self._waiting is not None:
+                request, self._waiting = self._waiting, None
+            else:
+                try:
+                    # only block for work while the batch is idle
+                    request = self._pending.get(block=not self._active)
+                except queue.Empty:
+                    return
+            if request is None:
+                return
+            if all(r.cancelled for r in request.samples) or request.max_tokens <= 0:
+                for r in request.samples:
+                    r.tokens.put(None)
+                continue
+            if len(self._active) + len(request.samples) > self.max_batch_size:
+                # every sample takes a row, wait until they all fit
+                self._waiting = request
+                return
+
+            tokens = request.prompt.tolist()
+            cache = self._make_cache(len(self.model.layers))
+            if self.prefix_cache is not None:
+                cached_tokens = self.prefix_cache.fetch(tokens, cache)
+                for r in request.samples:
+                    r.cached_tokens = cached_tokens
+
+            self._prefilling = (request, cache, request.prompt[request.cached_tokens:])
+            return
+
+    def _prefill(self):
+        """
+        Run the next `prefill_step_size` prompt tokens of the request being
+        prefilled, joining it to the batch after its last chunk.
+        """
+        request, cache, y = self._prefilling
+        try:
+            if all(r.cancelled for r in request.samples):
+                for r in request.samples:
+                    r.tokens.put(None)
+                self._prefilling = None
+                return
+
+            if y.size > self.prefill_step_size:
+                self.model(y[None, :self.prefill_step_size], cache=cache)
+                mx.eval([c.state for c in cache])
+                self._prefilling = (request, cache, y[self.prefill_step_size:])
+                return
+
+            self._prefilling = None
+            logits, cache = self.model(y[None], cache=cache, num_logits=1)
+            if self.prefix_cache is not None:
+                self.prefix_cache.insert(request.prompt.tolist(), cache)
+
+            if (request.repetition_penalty or request.presence_penalty
+                    or request.frequency_penalty):
+                for r in request.samples:
+                    r.penalty = PenaltyContext(
+                        r.prompt,
+                        logits.shape[-1],
+                        r.repetition_context_size,
+                        r.repetition_penalty,
+                        r.presence_penalty,
+                        r.frequency_penalty,
+                    )
+
+            # the first tokens are handed out by the next step
+            y = mx.concatenate(
+                [self._sample(r, logits[:, -1, :]) for r in request.samples])
+            async_eval(y, *self._logprobs(request.samples, logits[:, -1, :], y))
+
+            if request.num_draft_tokens > 0:
+                tokens = request.prompt.tolist()
+                if self.draft_model is not None:
+                    # runs the draft model only once the request is the
+                    # sole active one and decodes speculatively
+                    request.drafter = DraftModel(
+                        self.draft_model, tokens, request.num_draft_tokens,
+                        self.prefill_step_size, self.max_kv_size)
+                else:
+                    request.drafter = PromptLookup(
+                        tokens, num_draft_tokens=request.num_draft_tokens)
+
+            self._join(request.samples, cache, y)
+        except Exception as e:
+            self._prefilling = None
+            for r in request.samples:
+                r.tokens.put(e)
+
+    def _sample(self, request: Request, logits: mx.array) -> mx.array:
+        if request.penalty is not None:
+            logits = request.penalty(logits)
+        if request.constraint is not None:
+            logits = request.constraint(logits)
+        y, _ = sample(
+            logits, request.temp, request.top_p, request.top_k, request.min_p)
+        if request.penalty is not None:
+            request.penalty.update(y)
+        return y
+
+    @staticmethod
+    def _logprobs(requests: List[Request], logits: mx.array, y: mx.array) -> List[mx.array]:
+        """
+        Queue the log probabilities of the sampled tokens `y` and of the top
+        alternatives for the requests asking for them.
+
+        They are computed for the whole batch at once from the model's
+        distribution and stay on the device, returns the arrays to evaluate
+        with `y`.
+        """
+        if not any(r.logprobs for r in requests):
+            return []
+
+        logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+        logprobs = mx.broadcast_to(logprobs, (y.size, logprobs.shape[-1]))
+        chosen = mx.take_along_axis(logprobs, y.reshape(-1, 1), axis=-1)[:, 0]
+        k = min(max(r.top_logprobs for r in requests), logprobs.shape[-1])
+        if k > 0:
+            top = mx.argpartition(-logprobs, k - 1, axis=-1)[:, :k]
+            top_logprobs = mx.take_along_axis(logprobs, top, axis=-1)
+            order = mx.argsort(-top_logprobs, axis=-1)
+            top = mx.take_along_axis(top, order, axis=-1)
+            top_logprobs = mx.take_along_axis(top_logprobs, order, axis=-1)
+        else:
+            top = mx.zeros((y.size, 0), mx.uint32)
+            top_logprobs = mx.zeros((y.size, 0), logprobs.dtype)
+
+        for i, r in enumerate(requests):
+            if r.logprobs:
+                r.device_logprobs.append((
+                    chosen[i], top[i, :r.top_logprobs], top_logprobs[i, :r.top_logprobs]))
+        return [chosen, top, top_logprobs]
+
+    @staticmethod
+    def _finish(request: Request):
+        """
+        Read back the log probabilities of the emitted tokens in one
+        transfer, then close the request's token stream.
+        """
+        if request.logprobs:
+            emitted = request.device_logprobs[:request.num_tokens]
+            request.device_logprobs = []
+            request.token_logprobs = []
+            if emitted:
+                chosen, top, top_logprobs = (mx.stack(x) for x in zip(*emitted))
+                mx.eval(chosen, top, top_logprobs)
+                request.token_logprobs = [
+                    (logprob, list(zip(ids, values)))
+                    for logprob, ids, values in zip(
+                        chosen.tolist(), top.tolist(), top_logprobs.tolist())
+                ]
+        request.tokens.put(None)
+
+    def _emit(self, request: Request, token: int) -> bool:
+        """
+        Hand a decoded token to its request, returns True once it is finished.
+        """
+        if request.cancelled or token == request.eos_token_id:
+            self._finish(request)
+            return True
+
+        request.tokens.put(token)
+        request.num_tokens += 1
+        if request.drafter is not None:
+            request.drafter.extend([token])
+
+        if request.num_tokens >= request.max_tokens:
+            self._finish(request)
+            return True
+        return False
+
+    def _join(self, requests: List[Request], cache, y: mx.array):
+        if len(requests) > 1:
+            # fork the prefilled prompt into one row per sample
+            for c in cache:
+                c.repeat(len(requests))
+
+        pad = 0
+        if self._cache is None:
+            self._cache = cache
+        else:
+            self._pads = self._remaining_pads()
+            length = cache[0].size
+            total = self._cache[0].size
+            pad = max(total - length, 0)
+            batch = self._shift(self._cache, max(length - total, 0))
+            self._pads = [p + max(length - total, 0) for p in self._pads]
+            self._cache = [
+                self._from_state(*(
+                    mx.concatenate([a, b], axis=0)
+                    for a, b in zip(c.state, new_c.state)
+                ))
+                for c, new_c in zip(batch, self._shift(cache, pad))
+            ]
+
+        self._active.extend(requests)
+        self._pads.extend([pad] * len(requests))
+        y = y.reshape(-1, 1)
+        self._y = y if self._y is None else mx.concatenate([self._y, y], axis=0)
+
+    def _make_cache(self, num_layers: int) -> List[KVCache]:
+        return make_kv_cache(
+            num_layers, self.kv_bits, self.kv_group_size, self.max_kv_size,
+            self.model.sliding_window)
+
+    def _from_state(self, keys: mx.array, values: mx.array) -> KVCache:
+        cache, = self._make_cache(1)
+        cache.state = (keys, values)
+        return cache
+
+    @staticmethod
+    def _window(cache) -> Tuple[Optional[int], int]:
+        """
+        The maximum size and number of attention sinks of the cache.
+        """
+        if isinstance(cache[0], RotatingKVCache):
+            return cache[0].max_size, cache[0].keep
+        return None, 0
+
+    def _evicted(self, n: int = 0) -> int:
+        """
+        Number of positions a bounded batch cache has overwritten since it
+        was rebuilt, after `n` more decode steps.
+        """
+        max_size, _ = self._window(self._cache)
+        if max_size is None:
+            return 0
+        return max(self._cache[0].offset + n - max_size, 0)
+
+    def _remaining_pads(self) -> List[int]:
+        evicted = self._evicted()
+        return [max(p - evicted, 0) for p in self._pads]
+
+    def _shift(self, cache, n: int):
+        """
+        Insert `n` padding positions after the attention sinks of the cached
+        rows, or drop `-n` of them if negative, numbering the positions of
+        the shifted rows from zero.
+        """
+        _, keep = self._window(cache)
+        shifted = []
+        for layer, c in zip(self.model.layers, cache):
+            keys, values = c.state
+            # RoPE rotations compose, so rotating every cached key by the
+            # same number of positions keeps its distance to the next query
+            rotate = keys.shape[2] + n - c.offset
+            if rotate == 0 and n == 0:
+                shifted.append(c)
+                continue
+            if rotate != 0:
+                keys = layer.self_attn.rope(keys[..., None, :], offset=rotate)[..., 0, :]
+            if n > 0:
+                B, H, _, D = keys.shape
+                keys = mx.concatenate([
+                    keys[:, :, :keep], mx.zeros((B, H, n, D), keys.dtype), keys[:, :, keep:]
+                ], axis=2)
+                values = mx.concatenate([
+                    values[:, :, :keep],
+                    mx.zeros((B, H, n, values.shape[-1]), values.dtype),
+                    values[:, :, keep:],
+                ], axis=2)
+            elif n < 0:
+                keys = mx.concatenate(
+                    [keys[:, :, :keep], keys[:, :, keep - n:]], axis=2)
+                values = mx.concatenate(
+                    [values[:, :, :keep], values[:, :, keep - n:]], axis=2)
+            shifted.append(self._from_state(keys, values))
+        return shifted
+
+    def _step(self):
+        if len(self._active) == 1 and self._active[0].drafter is not None:
+            self._speculative_step()
+            return
+
+        mask = None
+        # a bounded cache overwrites the padding first, it follows the sinks
+        evicted = self._evicted(1)
+        if any(p > evicted for p in self._pads):
+            max_size, sinks = self._window(self._cache)
+            length = self._cache[0].size + 1
+            if max_size is not None:
+                length = min(length, max_size)
+            start = sinks + evicted
+            pads = sinks + mx.array(self._pads)[:, None]
+            positions = mx.arange(length)[None]
+            mask = mx.where((positions >= start) & (positions < pads), -1e9, 0.0)
+            mask = mask[:, None, None, :].astype(self._cache[0].dtype)
+
+        logits, self._cache = self.model(self._y, cache=self._cache, mask=mask)
+        logits = logits[:, -1, :]
+
+        tokens = None
+        if any(request.constraint is not None for request in self._active):
+            # the masks depend on the previous tokens, read them while the
+            # forward pass evaluates
+            async_eval(logits)
+            tokens = self._y[:, 0].tolist()
+            for request, token in zip(self._active, tokens):
+                if request.constraint is not None:
+                    request.constraint.advance(token)
+
+        y = mx.concatenate([
+            self._sample(request, logits[i:i + 1])
+            for i, request in enumerate(self._active)
+        ])
+        async_eval(y, *self._logprobs(self._active, logits, y))
+
+        # hand out the tokens of the previous step while this one evaluates
+        if tokens is None:
+            tokens = self._y[:, 0].tolist()
+        keep = [
+            i for i, (request, token) in enumerate(zip(self._active, tokens))
+            if not self._emit(request, token)
+        ]
+        self._y = y[:, None]
+        if len(keep) < len(self._active):
+            self._retire(keep)
+
+    def _speculative_step(self):
+        """
+        Draft tokens for the only active request and verify them in one
+        forward pass, see `speculative_generate_step`.
+        """
+        request = self._active[0]
+        # drafting continues from the token sampled by the previous step
+        if self._emit(request, self._y.item()):
+            self._retire([])
+            return
+
+        draft = request.drafter.propose()
+        inputs = mx.concatenate([self._y[0], mx.array(draft, dtype=self._y.dtype)])
+        logits, self._cache = self.model(
+            inputs[None], cache=self._cache, num_logits=len(draft) + 1)
+
+        finished = False
+        accepted = 0
+        logprobs = []
+        for i in range(len(draft) + 1):
+            y = self._sample(request, logits[:, i, :])
+            logprobs += self._logprobs([request], logits[:, i, :], y)
+            if i == len(draft) or y.item() != draft[i]:
+                break
+            accepted += 1
+            finished = self._emit(request, draft[i])
+            if finished:
+                break
+
+        request.stats.num_forwards += 1
+        request.stats.num_drafted += len(draft)
+        request.stats.num_accepted += accepted
+        if finished:
+            # the request ended on an accepted token, `y` is never emitted
+            request.stats.num_tokens += accepted
+            self._retire([])
+            return
+        request.stats.num_tokens += accepted + 1
+
+        # roll back the cache entries of the rejected draft tokens
+        for c in self._cache:
+            c.trim(len(draft) - accepted)
+        self._y = y.reshape(1, 1)
+        async_eval(self._y, *logprobs)
+
+    def _retire(self, keep: List[int]):
+        if not keep:
+            self._reset()
+            return
+
+        index = mx.array(keep)
+        self._active = [self._active[i] for i in keep]
+        self._pads = [self._remaining_pads()[i] for i in keep]
+        self._y = self._y[index]
+
+        # drop padding no remaining row needs
+        trim = min(self._pads)
+        self._pads = [p - trim for p in self._pads]
+        self._cache = [
+            self._from_state(keys[index], values[index])
+            for keys, values in (c.state for c in self._shift(self._cache, -trim))
+        ]
+
+    def _reset(self):
+        self._active = []
+        self._pads = []
+        self._cache = None
+        self._y = None
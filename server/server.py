@@ -2,16 +2,21 @@ import os
 import sys
 import json
 import time
+import contextlib
 import uuid
 
 import mlx.core as mx
 import mlx.nn as nn
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from typing import List, Dict, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Generator, Iterable, List, Optional
 from transformers import PreTrainedTokenizer
 
-from .utils import load, generate_step, get_mlx_path, convert
+from .utils import load, get_mlx_path, get_peak_rss, convert
+from .detokenizer import StopMatcher, StreamingDetokenizer
+from .constrained import Constraint
+from .scheduler import BatchScheduler, Request
+from .prefix_cache import PrefixCache
 
 from .retriever.loader import directory_loader
 from .retriever.splitter import RecursiveCharacterTextSplitter
@@ -21,20 +26,60 @@ from .retriever.embeddings import ChatEmbeddings, E5Embeddings
 _model: Optional[nn.Module] = None
 _tokenizer: Optional[PreTrainedTokenizer] = None
 _database: Optional[Chroma] = None
+_scheduler: Optional[BatchScheduler] = None
 
 
-def load_model(model_path: str, adapter_file: Optional[str] = None):
-    global _model
-    global _tokenizer
+class BadRequest(ValueError):
+    """
+    Invalid request body, answered with a 400.
+    """
 
+
+def get_converted_path(model_path: str) -> str:
     models_to_quantize = ['mistral', 'llama', 'gemma']
     quantize = any(variable in model_path for variable in models_to_quantize)
 
     mlx_path = get_mlx_path(model_path, quantize=quantize)
     if not os.path.isdir(mlx_path):
         convert(model_path, mlx_path, quantize=quantize)
+    return mlx_path
+
+
+def load_model(
+    model_path: str,
+    adapter_file: Optional[str] = None,
+    draft_model_path: Optional[str] = None,
+    kv_bits: Optional[int] = None,
+    max_kv_size: Optional[int] = None,
+    lazy: bool = False,
+    prefix_cache_mb: int = 256,
+):
+    global _model
+    global _tokenizer
+    global _scheduler
+
+    mlx_path = get_converted_path(model_path)
+
+    if _scheduler is not None:
+        _scheduler.stop()
 
-    _model, _tokenizer = load(mlx_path, adapter_file=adapter_file)
+    _model, _tokenizer = load(mlx_path, adapter_file=adapter_file, lazy=lazy, fuse=True)
+
+    # the draft model has to share the tokenizer of the main model
+    draft_model = None
+    if draft_model_path:
+        draft_model, _ = load(
+            get_converted_path(draft_model_path), lazy=lazy, fuse=True)
+
+    _scheduler = BatchScheduler(
+        _model,
+        # 0 disables caching prompt prefixes
+        prefix_cache=PrefixCache(max_bytes=prefix_cache_mb * 2**20)
+        if prefix_cache_mb > 0 else None,
+        draft_model=draft_model,
+        kv_bits=kv_bits,
+        max_kv_size=max_kv_size,
+    )
 
 
 def index_directory(directory: str, use_embedding: bool = True):
@@ -55,31 +100,176 @@ def index_directory(directory: str, use_embedding: bool = True):
           f'{time.time() - start_t:.2f}s', flush=True)
 
 
-def create_response(chat_id, prompt, tokens, text):
+def create_choice(index, text, finish_reason=None, logprobs=None):
+    return {
+        'index': index,
+        'message': {
+            'role': 'assistant',
+            'content': text,
+        },
+        'logprobs': logprobs,
+        'finish_reason': finish_reason,
+    }
+
+
+def create_logprobs(request: Request, tokens: List[int]):
+    if not request.logprobs:
+        return None
+    # a request stopped early is still finishing in the scheduler
+    request.wait()
+
+    def entry(token, logprob):
+        text = _tokenizer.decode([token])
+        return {
+            'token': text,
+            'logprob': logprob,
+            'bytes': list(text.encode('utf-8')),
+        }
+
+    return {
+        'content': [
+            dict(entry(token, logprob),
+                 top_logprobs=[entry(t, lp) for t, lp in top])
+            for token, (logprob, top) in zip(tokens, request.token_logprobs or [])
+        ],
+    }
+
+
+def create_response(chat_id, prompt, tokens, choices, cached_tokens=0, stats=None):
     response = {
         'id': chat_id,
         'object': 'chat.completion',
         'created': int(time.time()),
         'model':  _model.model_type,
         'system_fingerprint': f'fp_{uuid.uuid4()}',
+        'choices': choices,
+        'usage': create_usage(prompt, tokens, cached_tokens, stats),
+    }
+    return response
+
+
+def create_usage(prompt, tokens, cached_tokens=0, stats=None):
+    usage = {
+        'prompt_tokens': len(prompt),
+        'completion_tokens': len(tokens),
+        'total_tokens': len(prompt) + len(tokens),
+        'prompt_tokens_details': {
+            'cached_tokens': cached_tokens,
+        },
+    }
+    if stats is not None and stats.num_forwards > 0:
+        usage['speculative_decoding'] = {
+            'drafted_tokens': stats.num_drafted,
+            'accepted_tokens': stats.num_accepted,
+            'acceptance_rate': stats.acceptance_rate,
+            'tokens_per_forward': stats.tokens_per_forward,
+        }
+    return usage
+
+
+def finish_reason(tokens, body, stopped=False):
+    if stopped:
+        return 'stop'
+    return 'length' if len(tokens) >= body.get('max_tokens', 100) else 'stop'
+
+
+def stop_matcher(body) -> StopMatcher:
+    stop = body.get('stop', None) or []
+    return StopMatcher([stop] if isinstance(stop, str) else stop)
+
+
+def sample_count(body) -> int:
+    n = body.get('n', 1)
+    # every sample takes a row of the batch
+    if (not isinstance(n, int) or isinstance(n, bool)
+            or not 1 <= n <= _scheduler.max_batch_size):
+        raise BadRequest(
+            f"n must be an integer between 1 and {_scheduler.max_batch_size}, got {n!r}")
+    return n
+
+
+def create_constraint(response_format) -> Optional[Constraint]:
+    kind = (response_format or {}).get('type', 'text')
+    if kind == 'text':
+        return None
+    if kind == 'json_object':
+        return Constraint.from_json_schema(_tokenizer, {'type': 'object'})
+    if kind == 'json_schema':
+        return Constraint.from_json_schema(
+            _tokenizer, response_format['json_schema'].get('schema', {}))
+    if kind == 'regex':
+        return Constraint.from_regex(_tokenizer, response_format['regex'])
+    raise ValueError(f"Unsupported response_format type {kind!r}")
+
+
+def stream_text(request: Request, detokenizer: StreamingDetokenizer, matcher: StopMatcher):
+    """
+    Yield the response text of `request` as it grows.
+
+    The text which may still become a stop string is held back, and the
+    request is cancelled as soon as a stop string is generated, the stop
+    string itself is not part of the text.
+    """
+    with contextlib.closing(iter(request)) as tokens:
+        for token in tokens:
+            if matcher.feed(detokenizer.add_token(token)):
+                break
+            yield matcher.text[:len(matcher.text) - matcher.held]
+        else:
+            matcher.feed(detokenizer.finalize())
+    yield matcher.text
+
+
+def strip_sure(text: str, final: bool = True) -> Optional[str]:
+    """
+    Drop a leading "Sure, " and capitalize the text after it.
+
+    Returns None if the text is not `final` and may still grow into "Sure, ".
+    """
+    # TODO: GEMMA IS OBSESSED WITH "Sure, ..."
+    if text.startswith('Sure, '):
+        return text[6:7].upper() + text[7:]
+    if not final and 'Sure, '.startswith(text):
+        return None
+    return text
+
+
+def stream_deltas(texts: Iterable[str]) -> Generator[str, None, None]:
+    """
+    Yield the new text of each of the growing `texts`, stripped by
+    `strip_sure`. The text which may still grow into "Sure, " is held back
+    until it is decided, or sent as it is once the texts end.
+    """
+    sent = 0
+    text = ''
+    for text in texts:
+        stripped = strip_sure(text, final=False)
+        if stripped is not None and len(stripped) > sent:
+            yield stripped[sent:]
+            sent = len(stripped)
+    stripped = strip_sure(text)
+    if len(stripped) > sent:
+        yield stripped[sent:]
+
+
+def create_chunk(chat_id, delta, finish_reason=None, usage=None, index=0, logprobs=None):
+    chunk = {
+        'id': chat_id,
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': _model.model_type,
         'choices': [
             {
-                'index': 0,
-                'message': {
-                    'role': 'assistant',
-                    'content': text,
-                },
-                'logprobs': None,
-                'finish_reason': None,
+                'index': index,
+                'delta': delta,
+                'logprobs': logprobs,
+                'finish_reason': finish_reason,
             }
         ],
-        'usage': {
-            'prompt_tokens': len(prompt),
-            'completion_tokens': len(tokens),
-            'total_tokens': len(prompt) + len(tokens),
-        },
     }
-    return response
+    if usage is not None:
+        chunk['usage'] = usage
+    return chunk
 
 
 def format_messages(messages: List[Dict], indexed_files: Optional[str], instructions: Optional[Dict]):
@@ -115,14 +305,21 @@ def format_messages(messages: List[Dict], indexed_files: Optional[str], instruct
 
 
 class APIHandler(BaseHTTPRequestHandler):
-    def _set_headers(self, status_code=200):
+    def _set_headers(self, status_code=200, content_type='application/json'):
         self.send_response(status_code)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', '*')
         self.send_header('Access-Control-Allow-Headers', '*')
+        if content_type == 'text/event-stream':
+            self.send_header('Cache-Control', 'no-cache')
         self.end_headers()
 
+    def _send_event(self, data):
+        payload = data if isinstance(data, str) else json.dumps(data)
+        self.wfile.write(f'data: {payload}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
     def do_OPTIONS(self):
         self._set_headers(204)
 
@@ -139,7 +336,12 @@ class APIHandler(BaseHTTPRequestHandler):
             Desc: initializes the model
             Body:
                 {
-                    model: str
+                    model: str,
+                    draft_model: str,
+                    kv_bits: int,
+                    max_kv_size: int,
+                    lazy: bool,
+                    prefix_cache_mb: int
                 }
 
         Endpoint: /api/query
@@ -150,14 +352,36 @@ class APIHandler(BaseHTTPRequestHandler):
                     max_tokens: int,
                     repetition_penalty: float,
                     repetition_context_size: int,
+                    presence_penalty: float,
+                    frequency_penalty: float,
                     temperature: float,
                     top_p: float,
+                    top_k: int,
+                    min_p: float,
+                    num_draft_tokens: int,
+                    n: int,
+                    logprobs: bool,
+                    top_logprobs: int,
+                    response_format: {
+                        type: 'text' | 'json_object' | 'json_schema' | 'regex',
+                        json_schema: { schema: dict },
+                        regex: str
+                    },
+                    stop: str | [ str ],
                     instructions: {
                         personalization: str,
                         response: str
                     },
-                    directory: str
+                    directory: str,
+                    stream: bool
                 }
+            Stream:
+                when `stream` is true the response is sent as server-sent
+                events, one `chat.completion.chunk` per decoded delta, then a
+                final chunk carrying `finish_reason` and `usage`, then
+                `data: [DONE]`; the `n` choices are streamed one after the
+                other and only the last one carries `usage`; the `logprobs`
+                of a choice are read back once and sent with its final chunk
         """
         try:
             post_data = self.rfile.read(int(self.headers['Content-Length']))
@@ -173,10 +397,20 @@ class APIHandler(BaseHTTPRequestHandler):
                 self.wfile.write(b'Not Found')
                 return
 
+            if handle == self.query and body.get('stream', False):
+                self.stream(body)
+                return
+
             response = handle(body)
             self._set_headers(200)
             self.wfile.write(json.dumps(response).encode('utf-8'))
 
+        except (BrokenPipeError, ConnectionResetError):
+            # the client disconnected, the response can't be sent
+            return
+        except BadRequest as e:
+            self._set_headers(400)
+            self.wfile.write(json.dumps({'error': str(e)}).encode('utf-8'))
         except Exception as e:
             print(f"Error: {e}", flush=True)
             self._set_headers(500)
@@ -189,12 +423,29 @@ class APIHandler(BaseHTTPRequestHandler):
 
     def init(self, body):
         model = body.get('model', None)
-        load_model(model)
-        return {'model': model}
-
-    def query(self, body):
-        chat_id = f'chatcmpl-{uuid.uuid4()}'
-
+        draft_model = body.get('draft_model', None)
+        kv_bits = body.get('kv_bits', None)
+        max_kv_size = body.get('max_kv_size', None)
+        # a lazy model returns at once and reads its weights on first use
+        lazy = body.get('lazy', False)
+        prefix_cache_mb = body.get('prefix_cache_mb', 256)
+        tic = time.perf_counter()
+        load_model(model, draft_model_path=draft_model, kv_bits=kv_bits,
+                   max_kv_size=max_kv_size, lazy=lazy,
+                   prefix_cache_mb=prefix_cache_mb)
+        return {
+            'model': model,
+            'draft_model': draft_model,
+            'kv_bits': kv_bits,
+            'max_kv_size': max_kv_size,
+            'lazy': lazy,
+            'prefix_cache_mb': prefix_cache_mb,
+            'load_time': time.perf_counter() - tic,
+            # the high-water mark of the process, not of this load alone
+            'process_peak_rss': get_peak_rss(),
+        }
+
+    def _prepare_prompt(self, body):
         directory = body.get('directory', None)
         messages = body.get('messages', [])
         instructions = body.get('instructions', None)
@@ -215,45 +466,117 @@ class APIHandler(BaseHTTPRequestHandler):
         format_messages(messages, indexed_files, instructions)
         print(messages, flush=True)
 
-        prompt = mx.array(_tokenizer.encode(_tokenizer.apply_chat_template(
+        return mx.array(_tokenizer.encode(_tokenizer.apply_chat_template(
             messages,
             tokenize=False,
             add_generation_prompt=True,
         ), add_special_tokens=True))
 
+    def _generate(self, prompt, body):
         max_tokens = body.get('max_tokens', 100)
         repetition_penalty = body.get('repetition_penalty', None)
         repetition_context_size = body.get('repetition_context_size', 20)
+        presence_penalty = body.get('presence_penalty', 0.0)
+        frequency_penalty = body.get('frequency_penalty', 0.0)
         temperature = body.get('temperature', 1.0)
         top_p = body.get('top_p', 1.0)
+        top_k = body.get('top_k', 0)
+        min_p = body.get('min_p', 0.0)
+        num_draft_tokens = body.get(
+            'num_draft_tokens', 4 if _scheduler.draft_model is not None else 0)
+        n = sample_count(body)
+        logprobs = body.get('logprobs', False)
+        top_logprobs = body.get('top_logprobs', 0)
+        constraint = create_constraint(body.get('response_format', None))
+
+        return _scheduler.submit(
+            prompt,
+            max_tokens,
+            _tokenizer.eos_token_id,
+            temperature,
+            repetition_penalty,
+            repetition_context_size,
+            top_p,
+            num_draft_tokens,
+            presence_penalty,
+            frequency_penalty,
+            top_k,
+            min_p,
+            n,
+            logprobs,
+            top_logprobs,
+            constraint,
+        )
 
-        tokens = []
-        REPLACEMENT_CHAR = '\ufffd'
-        for (token, prob), _ in zip(
-            generate_step(
-                prompt,
-                _model,
-                temperature,
-                repetition_penalty,
-                repetition_context_size,
-                top_p,
-            ),
-            range(max_tokens),
-        ):
-            if token == _tokenizer.eos_token_id:
-                break
-            tokens.append(token.item())
+    def query(self, body):
+        chat_id = f'chatcmpl-{uuid.uuid4()}'
+        prompt = self._prepare_prompt(body)
 
-        text = _tokenizer.decode(tokens).replace(REPLACEMENT_CHAR, '')
-        # TODO: GEMMA IS OBSESSED WITH "Sure, ..."
-        if text.startswith('Sure, '):
-            text = text.split('\n')
-            text[0] = text[0].replace('Sure, ', '').capitalize()
-            text = '\n'.join([l for l in text])
-        return create_response(chat_id, prompt, tokens, text)
+        request = self._generate(prompt, body)
+        tokens, choices = [], []
+        try:
+            # the samples decode together, the later ones queue their tokens
+            for index, sample in enumerate(request.samples):
+                detokenizer = StreamingDetokenizer(_tokenizer)
+                matcher = stop_matcher(body)
+                for text in stream_text(sample, detokenizer, matcher):
+                    pass
+                tokens += detokenizer.tokens
+                choices.append(create_choice(
+                    index, strip_sure(text),
+                    finish_reason(detokenizer.tokens, body, matcher.stopped),
+                    create_logprobs(sample, detokenizer.tokens)))
+        finally:
+            # stop decoding the samples not read on an error
+            for sample in request.samples:
+                sample.cancelled = True
+        return create_response(chat_id, prompt, tokens, choices,
+                               request.cached_tokens, request.stats)
+
+    def stream(self, body):
+        chat_id = f'chatcmpl-{uuid.uuid4()}'
+        prompt = self._prepare_prompt(body)
+        request = self._generate(prompt, body)
+
+        try:
+            self._set_headers(200, content_type='text/event-stream')
+            tokens = []
+            # the samples decode together, each is streamed in turn while
+            # the later ones queue their tokens
+            for index, sample in enumerate(request.samples):
+                self._send_event(create_chunk(
+                    chat_id, {'role': 'assistant'}, index=index))
+                detokenizer = StreamingDetokenizer(_tokenizer)
+                matcher = stop_matcher(body)
+                for delta in stream_deltas(stream_text(sample, detokenizer, matcher)):
+                    self._send_event(create_chunk(
+                        chat_id, {'content': delta}, index=index))
+
+                tokens += detokenizer.tokens
+                usage = None
+                if index == len(request.samples) - 1:
+                    usage = create_usage(
+                        prompt, tokens, request.cached_tokens, request.stats)
+                self._send_event(create_chunk(
+                    chat_id, {},
+                    finish_reason(detokenizer.tokens, body, matcher.stopped),
+                    usage, index, create_logprobs(sample, detokenizer.tokens)))
+            self._send_event('[DONE]')
+        except (BrokenPipeError, ConnectionResetError):
+            # the client disconnected, there is nobody left to tell
+            return
+        except Exception as e:
+            print(f"Error: {e}", flush=True)
+            with contextlib.suppress(BrokenPipeError, ConnectionResetError):
+                self._send_event({'error': str(e)})
+                self._send_event('[DONE]')
+        finally:
+            # stop decoding the samples not streamed, e.g. on a disconnect
+            for sample in request.samples:
+                sample.cancelled = True
 
 
-def run(host: str, port: int, server_class=HTTPServer, handler_class=APIHandler):
+def run(host: str, port: int, server_class=ThreadingHTTPServer, handler_class=APIHandler):
     server_address = (host, port)
     httpd = server_class(server_address, handler_class)
     print(f'Starting httpd at {host} on port {port}...', flush=True)
@@ -0,0 +1,78 @@
+import json
+import re
+
+import pytest
+
+from server.constrained import _DFA, TokenIndex, json_schema_regex
+
+
+class CharTokenizer:
+    # one token per character of `chars`, after the end of sequence token
+    eos_token_id = 0
+    all_special_ids = [0]
+
+    def __init__(self, chars):
+        self.vocab = ['</s>'] + list(chars)
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.vocab[i] for i in ids]
+
+    def batch_decode(self, ids):
+        return ['' if i == 0 else self.vocab[i] for i, in ids]
+
+
+def matches(pattern, text):
+    dfa = _DFA(pattern)
+    state = dfa.start
+    for c in text:
+        state = dfa.step(state, c)
+        if state < 0:
+            return False
+    return dfa.accepting(state)
+
+
+OBJECTS = ['{}', '{ }', '{"a": 1}', '{"a": [1, {"b": null}], "c": "d"}']
+NON_OBJECTS = ['42', '"abc"', '[1,2]', 'null', 'true', '{"a": }', '{"a" 1}']
+
+
+@pytest.mark.parametrize('schema', [{'type': 'object'}, {'type': 'object', 'properties': {}}])
+@pytest.mark.parametrize('text', OBJECTS)
+def test_object_without_properties_accepts_objects(schema, text):
+    json.loads(text)
+    pattern = json_schema_regex(schema)
+    assert re.fullmatch(pattern, text)
+    assert matches(pattern, text)
+
+
+@pytest.mark.parametrize('schema', [{'type': 'object'}, {'type': 'object', 'properties': {}}])
+@pytest.mark.parametrize('text', NON_OBJECTS)
+def test_object_without_properties_rejects_non_objects(schema, text):
+    pattern = json_schema_regex(schema)
+    assert not re.fullmatch(pattern, text)
+    assert not matches(pattern, text)
+
+
+def test_untyped_schema_accepts_any_value():
+    pattern = json_schema_regex({})
+    for text in ['42', '"abc"', '[1, 2]', '{"a": 1}']:
+        assert matches(pattern, text)
+
+
+def test_token_index_builds_reachable_states_up_front():
+    assert len(TokenIndex(CharTokenizer('ab'), 'a+b')._next) == 4
+    assert len(TokenIndex(CharTokenizer('ab'), 'a+b', max_states=2)._next) == 2
+
+
+def test_token_index_mask_skips_tokens_past_vocab_size():
+    index = TokenIndex(CharTokenizer('abc'), '[abc]+')
+    assert index.mask(index.start, 3).tolist() == [False, True, True]
+
+
+def test_token_index_bounds_masks():
+    index = TokenIndex(CharTokenizer('0123456789'), '[0-9]{0,8}', max_masks=2)
+    for state in range(5):
+        index.mask(state, 11)
+    assert list(index._masks) == [3, 4]
@@ -0,0 +1,40 @@
+import mlx.core as mx
+
+from server.models.base import KVCache, QuantizedKVCache
+from server.prefix_cache import PrefixCache
+
+
+def _filled_cache(n_tokens, n_layers=2):
+    cache = [KVCache() for _ in range(n_layers)]
+    for c in cache:
+        kv = mx.ones((1, 2, n_tokens, 4))
+        c.update_and_fetch(kv, kv)
+    return cache
+
+
+def test_evicts_past_byte_budget():
+    block_bytes = 2 * 2 * (1 * 2 * 4 * 4 * 4)  # layers * (keys, values) * float32 block
+    pc = PrefixCache(block_size=4, max_bytes=2 * block_bytes)
+    pc.insert(list(range(12)), _filled_cache(12))
+    assert pc.nbytes == 2 * block_bytes
+
+
+def test_fetch_restores_cached_prefix():
+    pc = PrefixCache(block_size=4)
+    pc.insert(list(range(12)), _filled_cache(12))
+    cache = [KVCache() for _ in range(2)]
+    assert pc.fetch(list(range(10)), cache) == 8
+    assert cache[0].offset == 8
+
+
+def test_quantized_blocks_restored_without_requantizing():
+    cache = [QuantizedKVCache(group_size=32, bits=4)]
+    kv = mx.random.normal((1, 2, 12, 32))
+    cache[0].update_and_fetch(kv, kv)
+    pc = PrefixCache(block_size=4)
+    pc.insert(list(range(12)), cache)
+
+    restored = [QuantizedKVCache(group_size=32, bits=4)]
+    assert pc.fetch(list(range(10)), restored) == 8
+    for a, b in zip(restored[0].keys, cache[0].keys):
+        assert mx.array_equal(a, b[..., :8, :])
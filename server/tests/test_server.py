@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+import pytest
+
+from server import server
+from server.server import BadRequest, sample_count, stream_deltas, strip_sure
+
+
+def growing(text):
+    # the texts `stream_text` yields as the response grows one character at a time
+    return [text[:i] for i in range(1, len(text) + 1)] + [text]
+
+
+@pytest.mark.parametrize('text', ['S', 'Sur', 'Sure', 'Sure,', 'Hi', ''])
+def test_stream_short_output(text):
+    assert ''.join(stream_deltas(growing(text))) == text
+
+
+@pytest.mark.parametrize('text', [
+    'Sure, here it is',
+    'Sure, a NASA fact\nSure, again',
+    'Surely not',
+    'No. Sure, fine',
+])
+def test_stream_matches_full_response(text):
+    assert ''.join(stream_deltas(growing(text))) == strip_sure(text)
+
+
+def test_strip_sure():
+    assert strip_sure('Sure, the NASA') == 'The NASA'
+    assert strip_sure('Sure, ') == ''
+    assert strip_sure('Sure', final=False) is None
+    assert strip_sure('Sure') == 'Sure'
+
+
+def test_stream_holds_back_undecided_text():
+    assert list(stream_deltas(['S', 'Sur', 'Sure, ', 'Sure, ok'])) == ['Ok']
+
+
+@pytest.mark.parametrize('n', [0, 9, -1, '2', 1.5, True, None])
+def test_sample_count_rejects_invalid_n(monkeypatch, n):
+    monkeypatch.setattr(server, '_scheduler', SimpleNamespace(max_batch_size=8))
+    with pytest.raises(BadRequest):
+        sample_count({'n': n})
+
+
+def test_sample_count(monkeypatch):
+    monkeypatch.setattr(server, '_scheduler', SimpleNamespace(max_batch_size=8))
+    assert sample_count({}) == 1
+    assert sample_count({'n': 8}) == 8
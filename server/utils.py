@@ -5,9 +5,15 @@ import shutil
 import importlib
 import json
 import logging
+import mmap
+import resource
+import sys
 import time
+import weakref
+from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from typing import Any, Callable, Dict, Generator, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Union
 
 import mlx.core as mx
 import mlx.nn as nn
@@ -16,6 +22,12 @@ from mlx.utils import tree_flatten
 from huggingface_hub import snapshot_download
 from transformers import AutoConfig, AutoTokenizer, PreTrainedTokenizer
 
+from .models.base import KVCache, StaticKVCache, make_kv_cache
+from .constrained import Constraint
+from .detokenizer import StreamingDetokenizer
+from .prefix_cache import PrefixCache
+from .sampler import sample
+
 # Constants
 MODEL_REMAPPING = {
     "mistral": "llama",  # mistral is compatible with llama
@@ -24,6 +36,14 @@ MODEL_REMAPPING = {
 
 MAX_FILE_SIZE_GB = 5
 
+# schedules the evaluation without waiting for it, older MLX releases
+# only have the blocking eval
+async_eval = getattr(mx, "async_eval", mx.eval)
+
+# compiled decoding writes its cache in place with `mx.slice_update` and
+# rotates at an array offset, neither is in older MLX releases
+COMPILED_DECODE = hasattr(mx, "slice_update")
+
 linear_class_predicate = (
     lambda m: isinstance(m, nn.Linear)
     and m.weight.shape[0]
@@ -81,28 +101,139 @@ def get_model_path(path_or_hf_repo: str) -> Path:
     return model_path
 
 
-def apply_repetition_penalty(logits: mx.array, generated_tokens: Any, penalty: float):
+class PenaltyContext:
     """
-    Apply repetition penalty to specific logits based on the given context.
+    Repetition, presence and frequency penalties over the recent tokens.
+
+    The context is a fixed-size ring buffer of token ids with their counts
+    per vocabulary entry, both kept on the device and updated by scatters,
+    so penalizing a step adds no host work or synchronization.
+
+    Paper (repetition penalty): https://arxiv.org/abs/1909.05858
+
+    Args:
+        tokens (mx.array): The prompt tokens, its tail seeds the context.
+        vocab_size (int): Size of the logits penalized.
+        context_size (int, optional): Number of most recent tokens in the
+            context, all of them if None.
+        repetition_penalty (float, optional): Divides the positive (and
+            multiplies the negative) logits of the tokens in the context.
+        presence_penalty (float): Subtracted from the logits of the tokens
+            in the context.
+        frequency_penalty (float): Subtracted from the logits of the tokens
+            in the context once per occurrence.
+    """
+
+    def __init__(
+        self,
+        tokens: mx.array,
+        vocab_size: int,
+        context_size: Optional[int] = 20,
+        repetition_penalty: Optional[float] = None,
+        presence_penalty: float = 0.0,
+        frequency_penalty: float = 0.0,
+    ):
+        self.repetition_penalty = repetition_penalty
+        self.presence_penalty = presence_penalty
+        self.frequency_penalty = frequency_penalty
+        self.context_size = context_size
+
+        tokens = tokens.astype(mx.int32)
+        if context_size:
+            tokens = tokens[-context_size:]
+        self.counts = mx.zeros((vocab_size,), mx.int32).at[tokens].add(1)
+
+        # the ring buffer is only needed to know which token drops out
+        self._ring = None
+        self._size = tokens.size
+        if context_size:
+            self._ring = mx.zeros((context_size,), mx.int32)
+            self._ring[:tokens.size] = tokens
+        self._idx = self._size % context_size if context_size else 0
+
+    def update(self, y: mx.array):
+        """
+        Add a sampled token of shape (1,) to the context.
+        """
+        y = y.astype(mx.int32)
+        if self._ring is not None:
+            if self._size == self.context_size:
+                self.counts = self.counts.at[self._ring[self._idx]].add(-1)
+            else:
+                self._size += 1
+            self._ring[self._idx:self._idx + 1] = y
+            self._idx = (self._idx + 1) % self.context_size
+        self.counts = self.counts.at[y].add(1)
+
+    def __call__(self, logits: mx.array) -> mx.array:
+        """
+        Penalize the logits of shape (1, vocab_size) of the context tokens.
+        """
+        dtype = logits.dtype
+        if self.repetition_penalty:
+            logits = mx.where(
+                self.counts > 0,
+                mx.where(
+                    logits < 0,
+                    logits * self.repetition_penalty,
+                    logits / self.repetition_penalty,
+                ),
+                logits,
+            )
+        if self.presence_penalty:
+            logits = logits - self.presence_penalty * (self.counts > 0)
+        if self.frequency_penalty:
+            logits = logits - self.frequency_penalty * self.counts
+        return logits.astype(dtype)
+
 
-    Paper: https://arxiv.org/abs/1909.05858
+def prefill(
+    model: nn.Module,
+    prompt: mx.array,
+    prefix_cache: Optional[PrefixCache] = None,
+    prefill_step_size: int = 512,
+    kv_bits: Optional[int] = None,
+    kv_group_size: int = 64,
+    max_kv_size: Optional[int] = None,
+) -> Tuple[mx.array, List[KVCache]]:
+    """
+    Run the prompt through the model and build its KV cache.
 
     Args:
-        logits (mx.array): The logits produced by the language model.
-        generated_tokens (any): A list of N previous tokens.
-        penalty (float): The repetition penalty factor to be applied.
+        model (nn.Module): The model to use for generation.
+        prompt (mx.array): The input prompt.
+        prefix_cache (PrefixCache, optional): Cache of prompt prefixes, only
+            the uncached suffix of the prompt is prefilled.
+        prefill_step_size (int): Number of prompt tokens processed per
+            forward pass (default 512).
+        kv_bits (int, optional): Quantize the KV cache to this many bits.
+        kv_group_size (int): Group size of the KV cache quantization.
+        max_kv_size (int, optional): Bound the KV cache to this many
+            positions, the model's sliding window is used if it has one.
 
     Returns:
-        logits (mx.array): Logits with repetition penalty applied to generated tokens.
+        Tuple[mx.array, List[KVCache]]: The logits of the last prompt
+        position and the per-layer caches.
     """
-    if len(generated_tokens) > 0:
-        indices = mx.array([token for token in generated_tokens])
-        selected_logits = logits[:, indices]
-        selected_logits = mx.where(
-            selected_logits < 0, selected_logits * penalty, selected_logits / penalty
-        )
-        logits[:, indices] = selected_logits
-    return logits
+    prompt_tokens = prompt.tolist()
+
+    y = prompt
+    cache = make_kv_cache(
+        len(model.layers), kv_bits, kv_group_size, max_kv_size, model.sliding_window)
+    if prefix_cache is not None:
+        y = prompt[prefix_cache.fetch(prompt_tokens, cache):]
+
+    # prefill in chunks to bound the size of the attention activations
+    while y.size > prefill_step_size:
+        # the logits of a non-final chunk are never evaluated or projected
+        model(y[None, :prefill_step_size], cache=cache)
+        mx.eval([c.state for c in cache])
+        y = y[prefill_step_size:]
+
+    logits, cache = model(y[None], cache=cache, num_logits=1)
+    if prefix_cache is not None:
+        prefix_cache.insert(prompt_tokens, cache)
+    return logits, cache
 
 
 def generate_step(
@@ -112,6 +243,17 @@ def generate_step(
     repetition_penalty: Optional[float] = None,
     repetition_context_size: Optional[int] = 20,
     top_p: float = 1.0,
+    top_k: int = 0,
+    min_p: float = 0.0,
+    presence_penalty: float = 0.0,
+    frequency_penalty: float = 0.0,
+    prefix_cache: Optional[PrefixCache] = None,
+    prefill_step_size: int = 512,
+    kv_bits: Optional[int] = None,
+    kv_group_size: int = 64,
+    max_kv_size: Optional[int] = None,
+    compiled: bool = False,
+    constraint: Optional[Constraint] = None,
 ) -> Generator[Tuple[mx.array, mx.array], None, None]:
     """
     A generator producing text based on the given prompt from the model.
@@ -122,42 +264,35 @@ def generate_step(
         temp (float): The temperature for sampling, if 0 the argmax is used.
         repetition_penalty (float, optional): The penalty factor for repeating tokens.
         repetition_context_size (int, optional): The number of tokens to consider for repetition penalty (default 20).
+        top_p (float): Nucleus sampling threshold, disabled at 1.0.
+        top_k (int): Only sample from the `top_k` most likely tokens,
+            disabled at 0.
+        min_p (float): Only sample tokens at least `min_p` times as likely
+            as the most likely one, disabled at 0.0.
+        presence_penalty (float): Penalty for tokens present in the
+            repetition context.
+        frequency_penalty (float): Penalty per occurrence of a token in the
+            repetition context.
+        prefix_cache (PrefixCache, optional): Cache of prompt prefixes, only
+            the uncached suffix of the prompt is prefilled.
+        prefill_step_size (int): Number of prompt tokens processed per
+            forward pass during prefill (default 512).
+        kv_bits (int, optional): Quantize the KV cache to this many bits.
+        kv_group_size (int): Group size of the KV cache quantization.
+        max_kv_size (int, optional): Bound the KV cache to this many
+            positions, keeping the first ones as attention sinks.
+        compiled (bool): Decode with a `CompiledDecodeStep`, which needs
+            the full precision unbounded KV cache. Decodes eagerly on MLX
+            releases without `mx.slice_update`.
+        constraint (Constraint, optional): Only sample the tokens continuing
+            a match of its regular expression or JSON schema, it is advanced
+            past each generated token.
 
     Yields:
         Generator[Tuple[mx.array, mx.array]]: A generator producing
         one token and probability per call.
     """
 
-    def sample(logits: mx.array) -> Tuple[mx.array, float]:
-        softmax_logits = mx.softmax(logits)
-
-        if temp == 0:
-            token = mx.argmax(logits, axis=-1)
-        else:
-            if top_p > 0 and top_p < 1.0:
-                if (
-                    logits.dtype == mx.bfloat16
-                ):  # workdaround for unable to load kernel contiguous_scan_inclusive_sum_bfloat16_bfloat16
-                    logits = logits.astype(mx.float32)
-                probs = mx.softmax(logits / temp, axis=-1)
-
-                sorted_probs = mx.sort(probs)[::-1]
-                sorted_indices = mx.argsort(probs)[::-1]
-                cumulative_probs = mx.cumsum(sorted_probs, axis=-1)
-
-                top_probs = mx.where(
-                    cumulative_probs > 1 - top_p,
-                    sorted_probs,
-                    mx.zeros_like(sorted_probs),
-                )
-                sorted_token = mx.random.categorical(mx.log(top_probs))
-                token = sorted_indices.squeeze(0)[sorted_token]
-            else:
-                token = mx.random.categorical(logits * (1 / temp))
-
-        prob = softmax_logits[0, token]
-        return token, prob
-
     if repetition_penalty and (
         repetition_penalty < 0 or not isinstance(repetition_penalty, float)
     ):
@@ -166,31 +301,387 @@ def generate_step(
                 repetition_penalty}"
         )
 
-    y = prompt
-    cache = None
+    logits, cache = prefill(
+        model, prompt, prefix_cache, prefill_step_size, kv_bits, kv_group_size,
+        max_kv_size)
+    if compiled and not COMPILED_DECODE:
+        logging.warning(
+            f"mlx {mx.__version__} has no mx.slice_update, decoding eagerly")
+        compiled = False
+    decode = CompiledDecodeStep(model, cache) if compiled else None
+
+    penalty = None
+    if repetition_penalty or presence_penalty or frequency_penalty:
+        penalty = PenaltyContext(
+            prompt, logits.shape[-1], repetition_context_size,
+            repetition_penalty, presence_penalty, frequency_penalty)
+
+    def _step(logits):
+        logits = logits[:, -1, :]
+        if penalty is not None:
+            logits = penalty(logits)
+        if constraint is not None:
+            logits = constraint(logits)
+        y, prob = sample(logits, temp, top_p, top_k, min_p)
+        if penalty is not None:
+            penalty.update(y)
+        return y, prob
+
+    y, prob = _step(logits)
+    async_eval(y)
+    while True:
+        # queue the next step before handing out this token, so building
+        # its graph overlaps with the evaluation of the current one, the
+        # probability is only computed if the caller reads it
+        if decode is not None:
+            logits = decode(y[None])
+        else:
+            logits, cache = model(y[None], cache=cache)
+        if constraint is not None:
+            # the next mask depends on this token, read it while the
+            # forward pass evaluates
+            async_eval(logits)
+            constraint.advance(y.item())
+        next_y, next_prob = _step(logits)
+        async_eval(next_y)
+        yield y, prob
+        y, prob = next_y, next_prob
 
-    repetition_context = prompt.tolist()
 
-    if repetition_context_size:
-        repetition_context = repetition_context[-repetition_context_size:]
+def _decode_step(model_ref: weakref.ref, y, offset, *state):
+    cache = [
+        StaticKVCache(keys, values, offset)
+        for keys, values in zip(state[::2], state[1::2])
+    ]
+    # the buffer past the new position is empty
+    positions = mx.arange(state[0].shape[2])
+    mask = mx.where(positions <= offset, 0.0, -1e9).astype(state[0].dtype)
+    logits, cache = model_ref()(y, cache=cache, mask=mask[None, None, None])
+    return (logits, *(x for c in cache for x in (c.keys, c.values)))
 
-    while True:
-        logits, cache = model(y[None], cache=cache)
-        logits = logits[:, -1, :]
 
-        if repetition_penalty:
-            logits = apply_repetition_penalty(
-                logits, repetition_context, repetition_penalty
-            )
-            y, prob = sample(logits)
-            repetition_context.append(y.item())
-        else:
-            y, prob = sample(logits)
+class CompiledDecodeStep:
+    """
+    Single token decode step of a decoder model compiled with `mx.compile`.
 
-        if repetition_context_size:
-            if len(repetition_context) > repetition_context_size:
-                repetition_context = repetition_context[-repetition_context_size:]
+    The per-layer caches are copied into `StaticKVCache` buffers of a
+    fixed capacity, passed to the compiled step as inputs, so every step
+    has the same shapes and the graph of the whole model is traced once
+    instead of rebuilt in Python per token. The capacity grows by `step`
+    positions when it is full. The compiled steps are kept per model and
+    capacity, so later generations and growths to a capacity seen before
+    reuse the trace.
+
+    Args:
+        model (nn.Module): The decoder model (llama or gemma).
+        cache (List[KVCache]): The prefilled full precision caches.
+        step (int): Number of positions the capacity grows by.
+    """
+
+    # the compiled steps of the live models by capacity
+    _compiled: Dict[int, Dict[int, Callable]] = {}
+
+    def __init__(self, model: nn.Module, cache: List[KVCache], step: int = 256):
+        if not COMPILED_DECODE:
+            raise ValueError(
+                f"compiled decoding needs mx.slice_update, mlx {mx.__version__} does not have it")
+        if any(type(c) is not KVCache for c in cache):
+            raise ValueError("compiled decoding needs the full precision unbounded KV cache")
+        self.step = step
+        self.offset = cache[0].offset
+        self._model = weakref.ref(model)
+        self._steps = self._compiled.get(id(model))
+        if self._steps is None:
+            self._steps = self._compiled[id(model)] = {}
+            # the traces hold on to the weights, drop them with the model
+            weakref.finalize(model, self._compiled.pop, id(model), None)
+        self._state = [x for c in cache for x in c.state]
+        self._grow()
+
+    def _grow(self):
+        capacity = (self.offset // self.step + 1) * self.step
+        grown = []
+        for x in self._state:
+            B, H, L, D = x.shape
+            pad = mx.zeros((B, H, capacity - L, D), x.dtype)
+            grown.append(mx.concatenate([x[..., :self.offset, :], pad], axis=2))
+        self._state = grown
+
+    def __call__(self, y: mx.array) -> mx.array:
+        """
+        Run the token `y` of shape (1, 1) and return the logits of shape
+        (1, 1, vocab_size).
+        """
+        if self.offset == self._state[0].shape[2]:
+            self._grow()
+        capacity = self._state[0].shape[2]
+        if capacity not in self._steps:
+            self._steps[capacity] = mx.compile(partial(_decode_step, self._model))
+        logits, *self._state = self._steps[capacity](
+            y, mx.array(self.offset), *self._state)
+        self.offset += 1
+        return logits
+
+
+class PromptLookup:
+    """
+    Draft-free proposer for speculative decoding.
+
+    Indexes every n-gram (up to `ngram_size`) of the prompt and generated
+    tokens, and proposes the tokens that followed the most recent earlier
+    occurrence of the current suffix. Retrieval answers copy long spans of
+    the prompt, so these drafts are often accepted.
+
+    Args:
+        tokens (List[int]): The prompt token ids.
+        ngram_size (int): Longest suffix to match, shorter ones are tried
+            when it is not found.
+        num_draft_tokens (int): Maximum number of proposed tokens.
+    """
+
+    def __init__(self, tokens: List[int], ngram_size: int = 3, num_draft_tokens: int = 10):
+        self.ngram_size = ngram_size
+        self.num_draft_tokens = num_draft_tokens
+        self.tokens: List[int] = []
+        # n-gram -> position of the token that followed its last occurrence
+        self._index: Dict[Tuple[int, ...], int] = {}
+        self.extend(tokens)
+
+    def extend(self, tokens: List[int]):
+        for token in tokens:
+            self.tokens.append(token)
+            end = len(self.tokens) - 1
+            for n in range(1, min(self.ngram_size, end) + 1):
+                self._index[tuple(self.tokens[end - n:end])] = end
+
+    def propose(self) -> List[int]:
+        for n in range(min(self.ngram_size, len(self.tokens)), 0, -1):
+            start = self._index.get(tuple(self.tokens[-n:]))
+            if start is not None:
+                return self.tokens[start:start + self.num_draft_tokens]
+        return []
+
+
+class DraftModel:
+    """
+    Proposer for speculative decoding backed by a small draft model.
+
+    The draft model must share the tokenizer of the main model. It drafts
+    greedily on its own KV cache, which is rolled back to the accepted
+    tokens before every proposal. The cache is only prefilled by the first
+    proposal, a generation that is never decoded speculatively doesn't run
+    the draft model at all.
+
+    Args:
+        model (nn.Module): The draft model.
+        tokens (List[int]): The prompt token ids.
+        num_draft_tokens (int): Number of tokens drafted per proposal.
+        prefill_step_size (int): Number of prompt tokens processed per
+            forward pass when prefilling the draft model.
+        max_kv_size (int, optional): Bound the draft KV cache to this many
+            positions.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        tokens: List[int],
+        num_draft_tokens: int = 4,
+        prefill_step_size: int = 512,
+        max_kv_size: Optional[int] = None,
+    ):
+        self.model = model
+        self.num_draft_tokens = num_draft_tokens
+        self.prefill_step_size = prefill_step_size
+        self.max_kv_size = max_kv_size
+        self.tokens = list(tokens)
+        self.cache: Optional[List[KVCache]] = None
+        self._base = len(self.tokens)
+        self._draft: List[int] = []
+
+    def extend(self, tokens: List[int]):
+        self.tokens.extend(tokens)
+
+    def propose(self) -> List[int]:
+        if self.cache is None:
+            # the last token is the first input of the drafting below
+            _, self.cache = prefill(
+                self.model, mx.array(self.tokens[:-1]),
+                prefill_step_size=self.prefill_step_size,
+                max_kv_size=self.max_kv_size)
+            self._base = len(self.tokens) - 1
+            self._draft = []
+
+        # keep the cached draft tokens that were accepted, drop the rest
+        accepted = 0
+        for drafted, token in zip(self._draft, self.tokens[self._base:self.cache[0].offset]):
+            if drafted != token:
+                break
+            accepted += 1
+        for c in self.cache:
+            c.trim(c.offset - (self._base + accepted))
+
+        inputs = self.tokens[self._base + accepted:]
+        draft = []
+        for _ in range(self.num_draft_tokens):
+            logits, self.cache = self.model(
+                mx.array(inputs)[None], cache=self.cache, num_logits=1)
+            inputs = [mx.argmax(logits[:, -1, :], axis=-1).item()]
+            draft.extend(inputs)
+
+        self._base = len(self.tokens)
+        self._draft = draft
+        return draft
+
+
+@dataclass
+class SpeculativeStats:
+    """
+    Counters of a speculative decoding run.
+    """
+
+    num_drafted: int = 0
+    num_accepted: int = 0
+    num_forwards: int = 0
+    num_tokens: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.num_accepted / self.num_drafted if self.num_drafted else 0.0
+
+    @property
+    def tokens_per_forward(self) -> float:
+        return self.num_tokens / self.num_forwards if self.num_forwards else 0.0
+
+
+def speculative_generate_step(
+    prompt: mx.array,
+    model: nn.Module,
+    temp: 0.0,
+    repetition_penalty: Optional[float] = None,
+    repetition_context_size: Optional[int] = 20,
+    top_p: float = 1.0,
+    top_k: int = 0,
+    min_p: float = 0.0,
+    presence_penalty: float = 0.0,
+    frequency_penalty: float = 0.0,
+    prefix_cache: Optional[PrefixCache] = None,
+    prefill_step_size: int = 512,
+    kv_bits: Optional[int] = None,
+    kv_group_size: int = 64,
+    max_kv_size: Optional[int] = None,
+    num_draft_tokens: int = 10,
+    ngram_size: int = 3,
+    draft_model: Optional[nn.Module] = None,
+    stats: Optional[SpeculativeStats] = None,
+) -> Generator[Tuple[mx.array, mx.array], None, None]:
+    """
+    A generator producing text with speculative decoding.
+
+    Each round drafts up to `num_draft_tokens` tokens, with `DraftModel` if
+    a draft model is given and `PromptLookup` otherwise, verifies them in a
+    single forward pass and keeps the longest prefix the model agrees with,
+    plus the model's own next token. A position accepts its draft token
+    only if the token sampled from the model's distribution equals it, so
+    the output follows the same distribution as `generate_step`.
+
+    Args:
+        prompt (mx.array): The input prompt.
+        model (nn.Module): The model to use for generation.
+        temp (float): The temperature for sampling, if 0 the argmax is used.
+        repetition_penalty (float, optional): The penalty factor for repeating tokens.
+        repetition_context_size (int, optional): The number of tokens to consider for repetition penalty (default 20).
+        top_p (float): Nucleus sampling threshold, disabled at 1.0.
+        top_k (int): Only sample from the `top_k` most likely tokens,
+            disabled at 0.
+        min_p (float): Only sample tokens at least `min_p` times as likely
+            as the most likely one, disabled at 0.0.
+        presence_penalty (float): Penalty for tokens present in the
+            repetition context.
+        frequency_penalty (float): Penalty per occurrence of a token in the
+            repetition context.
+        prefix_cache (PrefixCache, optional): Cache of prompt prefixes, only
+            the uncached suffix of the prompt is prefilled.
+        prefill_step_size (int): Number of prompt tokens processed per
+            forward pass during prefill (default 512).
+        kv_bits (int, optional): Quantize the KV cache to this many bits.
+        kv_group_size (int): Group size of the KV cache quantization.
+        max_kv_size (int, optional): Bound the KV cache to this many
+            positions, keeping the first ones as attention sinks.
+        num_draft_tokens (int): Maximum number of tokens drafted per round.
+        ngram_size (int): Longest suffix matched against earlier tokens.
+        draft_model (nn.Module, optional): Small model sharing the tokenizer
+            used to draft tokens.
+        stats (SpeculativeStats, optional): Updated with the number of
+            drafted/accepted tokens and forward passes.
+
+    Yields:
+        Generator[Tuple[mx.array, mx.array]]: A generator producing
+        one token and probability per call.
+    """
+    if repetition_penalty and (
+        repetition_penalty < 0 or not isinstance(repetition_penalty, float)
+    ):
+        raise ValueError(
+            f"repetition_penalty must be a non-negative float, got {repetition_penalty}"
+        )
+
+    logits, cache = prefill(
+        model, prompt, prefix_cache, prefill_step_size, kv_bits, kv_group_size,
+        max_kv_size)
+    if draft_model is not None:
+        drafter = DraftModel(
+            draft_model, prompt.tolist(), num_draft_tokens, prefill_step_size,
+            max_kv_size)
+    else:
+        drafter = PromptLookup(prompt.tolist(), ngram_size, num_draft_tokens)
+    if stats is None:
+        stats = SpeculativeStats()
+
+    penalty = None
+    if repetition_penalty or presence_penalty or frequency_penalty:
+        penalty = PenaltyContext(
+            prompt, logits.shape[-1], repetition_context_size,
+            repetition_penalty, presence_penalty, frequency_penalty)
+
+    def _sample(logits):
+        if penalty is not None:
+            logits = penalty(logits)
+        y, prob = sample(logits, temp, top_p, top_k, min_p)
+        if penalty is not None:
+            penalty.update(y)
+        return y, prob
+
+    y, prob = _sample(logits[:, -1, :])
+    while True:
         yield y, prob
+        drafter.extend([y.item()])
+
+        draft = drafter.propose()
+        inputs = mx.concatenate([y, mx.array(draft, dtype=y.dtype)])
+        logits, cache = model(inputs[None], cache=cache, num_logits=len(draft) + 1)
+
+        # counted as the tokens are yielded, the caller may stop at any of them
+        stats.num_forwards += 1
+        stats.num_drafted += len(draft)
+        accepted = 0
+        for token in draft:
+            y, prob = _sample(logits[:, accepted, :])
+            if y.item() != token:
+                break
+            accepted += 1
+            stats.num_accepted += 1
+            stats.num_tokens += 1
+            yield y, prob
+            drafter.extend([token])
+        else:
+            y, prob = _sample(logits[:, accepted, :])
+        # the token sampled after the accepted ones is yielded next
+        stats.num_tokens += 1
+
+        # roll back the cache entries of the rejected draft tokens
+        for c in cache:
+            c.trim(len(draft) - accepted)
 
 
 def generate(
@@ -204,6 +695,16 @@ def generate(
     repetition_penalty: Optional[float] = None,
     repetition_context_size: Optional[int] = None,
     top_p: float = 1.0,
+    top_k: int = 0,
+    min_p: float = 0.0,
+    presence_penalty: float = 0.0,
+    frequency_penalty: float = 0.0,
+    num_draft_tokens: int = 0,
+    draft_model: Optional[nn.Module] = None,
+    kv_bits: Optional[int] = None,
+    max_kv_size: Optional[int] = None,
+    compiled: bool = False,
+    constraint: Optional[Constraint] = None,
 ) -> str:
     """
     Generate text from the model.
@@ -220,7 +721,30 @@ def generate(
            probability and displays it.
        repetition_penalty (float, optional): The penalty factor for repeating tokens.
        repetition_context_size (int, optional): The number of tokens to consider for repetition penalty.
+       top_p (float): Nucleus sampling threshold, disabled at 1.0.
+       top_k (int): Only sample from the `top_k` most likely tokens,
+           disabled at 0.
+       min_p (float): Only sample tokens at least `min_p` times as likely as
+           the most likely one, disabled at 0.0.
+       presence_penalty (float): Penalty for tokens present in the
+           repetition context.
+       frequency_penalty (float): Penalty per occurrence of a token in the
+           repetition context.
+       num_draft_tokens (int): If positive, use speculative decoding with up
+           to this many drafted tokens per step.
+       draft_model (nn.Module, optional): Small model drafting the tokens,
+           prompt lookup is used without it.
+       kv_bits (int, optional): Quantize the KV cache to this many bits.
+       max_kv_size (int, optional): Bound the KV cache to this many positions,
+           keeping the first ones as attention sinks.
+       compiled (bool): Decode with a compiled single token step, ignored
+           with speculative decoding.
+       constraint (Constraint, optional): Constrain the generated text to a
+           regular expression or JSON schema, not supported with
+           speculative decoding.
     """
+    if constraint is not None and num_draft_tokens > 0:
+        raise ValueError("constraint is not supported with speculative decoding")
 
     if verbose:
         print("=" * 10)
@@ -230,42 +754,65 @@ def generate(
     print(prompt_tokens, flush=True)
 
     tic = time.perf_counter()
-    tokens = []
-    skip = 0
-    REPLACEMENT_CHAR = "\ufffd"
+    detokenizer = StreamingDetokenizer(tokenizer)
 
-    for (token, prob), n in zip(
-        generate_step(
+    stats = SpeculativeStats()
+    if num_draft_tokens > 0:
+        generator = speculative_generate_step(
             prompt_tokens,
             model,
             temp,
             repetition_penalty,
             repetition_context_size,
             top_p,
-        ),
-        range(max_tokens),
-    ):
+            top_k,
+            min_p,
+            presence_penalty,
+            frequency_penalty,
+            num_draft_tokens=num_draft_tokens,
+            draft_model=draft_model,
+            stats=stats,
+            kv_bits=kv_bits,
+            max_kv_size=max_kv_size,
+        )
+    else:
+        generator = generate_step(
+            prompt_tokens,
+            model,
+            temp,
+            repetition_penalty,
+            repetition_context_size,
+            top_p,
+            top_k,
+            min_p,
+            presence_penalty,
+            frequency_penalty,
+            kv_bits=kv_bits,
+            max_kv_size=max_kv_size,
+            compiled=compiled,
+            constraint=constraint,
+        )
+
+    for (token, prob), n in zip(generator, range(max_tokens)):
         if token == tokenizer.eos_token_id:
             break
         if n == 0:
             prompt_time = time.perf_counter() - tic
             tic = time.perf_counter()
-        tokens.append(token.item())
+        segment = detokenizer.add_token(token.item())
 
         if verbose:
-            s = tokenizer.decode(tokens)
             if formatter:
-                formatter(s[skip:], prob.item())
-                skip = len(s)
-            elif REPLACEMENT_CHAR not in s:
-                print(s[skip:], end="", flush=True)
-                skip = len(s)
+                formatter(segment, prob.item())
+            else:
+                print(segment, end="", flush=True)
 
-    token_count = len(tokens)
-    token_string = tokenizer.decode(tokens).replace(REPLACEMENT_CHAR, "")
+    token_count = len(detokenizer.tokens)
+    segment = detokenizer.finalize()
+    token_string = detokenizer.text
 
     if verbose:
-        print(token_string[skip:], flush=True)
+        print(segment, flush=True)
         gen_time = time.perf_counter() - tic
         print("=" * 10)
         if token_count == 0:
@@ -275,11 +822,236 @@ def generate(
         gen_tps = (token_count - 1) / gen_time
         print(f"Prompt: {prompt_tps:.3f} tokens-per-sec")
         print(f"Generation: {gen_tps:.3f} tokens-per-sec")
+        if stats.num_forwards:
+            print(f"Acceptance: {stats.acceptance_rate:.3f},",
+                  f"{stats.tokens_per_forward:.3f} tokens-per-forward")
 
     return token_string
 
 
-def load_model(model_path: Path, lazy: bool = False) -> nn.Module:
+def make_batch_mask(
+    pads: mx.array,
+    offset: int,
+    N: int,
+    dtype: mx.Dtype,
+    sliding_window: Optional[int] = None,
+) -> mx.array:
+    """
+    Additive mask of `N` new positions of left padded rows over the cached
+    ones.
+
+    A position attends causally to the positions after its row's padding,
+    and to itself so the padded positions never have every score masked.
+
+    Args:
+        pads (mx.array): Number of padding positions of each row, shape (B,).
+        offset (int): Number of cached positions.
+        N (int): Number of new positions.
+        dtype (mx.Dtype): Type of the mask.
+        sliding_window (int, optional): Only attend to this many positions.
+
+    Returns:
+        mx.array: The mask of shape (B, 1, N, offset + N).
+    """
+    queries = mx.arange(offset, offset + N)[:, None]
+    keys = mx.arange(offset + N)[None]
+    visible = (keys <= queries) & (keys >= pads[:, None, None, None])
+    if sliding_window is not None:
+        visible = visible & (queries - keys < sliding_window)
+    visible = visible | (keys == queries)
+    return mx.where(visible, 0.0, -1e9).astype(dtype)
+
+
+def batch_generate_step(
+    prompts: List[mx.array],
+    model: nn.Module,
+    eos_token_id: Optional[int],
+    max_tokens: int,
+    temp: float = 0.0,
+    top_p: float = 1.0,
+    top_k: int = 0,
+    min_p: float = 0.0,
+    prefill_step_size: int = 512,
+    kv_bits: Optional[int] = None,
+    kv_group_size: int = 64,
+) -> Generator[Tuple[List[int], List[int]], None, None]:
+    """
+    A generator decoding several prompts together in batched forward passes.
+
+    The prompts are left padded to a common length and the padding is
+    masked out, RoPE only depends on the distance between positions so a
+    padded row decodes as it would alone. A row is retired from the batch
+    once it generates `eos_token_id` (not yielded) or `max_tokens` tokens.
+
+    Args:
+        prompts (List[mx.array]): The input prompts.
+        model (nn.Module): The model to use for generation.
+        eos_token_id (int, optional): The token ending a row.
+        max_tokens (int): The maximum number of tokens per row.
+        temp (float): The temperature for sampling, if 0 the argmax is used.
+        top_p (float): Nucleus sampling threshold, disabled at 1.0.
+        top_k (int): Only sample from the `top_k` most likely tokens,
+            disabled at 0.
+        min_p (float): Only sample tokens at least `min_p` times as likely
+            as the most likely one, disabled at 0.0.
+        prefill_step_size (int): Number of prompt positions processed per
+            forward pass during prefill (default 512).
+        kv_bits (int, optional): Quantize the KV cache to this many bits.
+        kv_group_size (int): Group size of the KV cache quantization.
+
+    Yields:
+        Generator[Tuple[List[int], List[int]]]: The indices of the active
+        prompts and their next token, one step per call.
+    """
+    if max_tokens <= 0 or not prompts:
+        return
+
+    length = max(p.size for p in prompts)
+    rows = list(range(len(prompts)))
+    pads = [length - p.size for p in prompts]
+    # any token id does for the padding, it is masked out
+    y = mx.stack([
+        mx.concatenate([mx.zeros(length - p.size, p.dtype), p]) for p in prompts
+    ])
+    window = model.sliding_window
+    cache = make_kv_cache(len(model.layers), kv_bits, kv_group_size)
+    # the type of the activations, the embedding itself may be quantized
+    dtype = model.model.embed_tokens(y[:1, :1]).dtype
+
+    def _mask(N):
+        return make_batch_mask(mx.array(pads), cache[0].offset, N, dtype, window)
+
+    while y.shape[1] > prefill_step_size:
+        model(y[:, :prefill_step_size], cache=cache, mask=_mask(prefill_step_size))
+        mx.eval([c.state for c in cache])
+        y = y[:, prefill_step_size:]
+    logits, cache = model(y, cache=cache, mask=_mask(y.shape[1]), num_logits=1)
+    y, _ = sample(logits[:, -1, :], temp, top_p, top_k, min_p)
+    async_eval(y)
+
+    num_tokens = 0
+    while True:
+        # the padding only needs a mask while some row has it
+        mask = _mask(1) if window is not None or max(pads) > 0 else None
+        logits, cache = model(y[:, None], cache=cache, mask=mask)
+        next_y, _ = sample(logits[:, -1, :], temp, top_p, top_k, min_p)
+        async_eval(next_y)
+
+        num_tokens += 1
+        tokens = y.tolist()
+        keep = [i for i, token in enumerate(tokens) if token != eos_token_id]
+        if keep:
+            yield [rows[i] for i in keep], [tokens[i] for i in keep]
+        if num_tokens >= max_tokens or not keep:
+            return
+
+        y = next_y
+        if len(keep) < len(rows):
+            index = mx.array(keep)
+            rows = [rows[i] for i in keep]
+            pads = [pads[i] for i in keep]
+            y = y[index]
+            for c in cache:
+                c.state = tuple(x[index] for x in c.state)
+
+
+def batch_generate(
+    model: nn.Module,
+    tokenizer: PreTrainedTokenizer,
+    prompts: List[str],
+    temp: float = 0.0,
+    max_tokens: int = 100,
+    verbose: bool = False,
+    top_p: float = 1.0,
+    top_k: int = 0,
+    min_p: float = 0.0,
+    batch_size: int = 8,
+    kv_bits: Optional[int] = None,
+) -> List[str]:
+    """
+    Generate text for several prompts, decoding up to `batch_size` together.
+
+    The prompts are batched by length so little padding is needed, the
+    responses are returned in the order of `prompts`.
+
+    Args:
+       model (nn.Module): The language model.
+       tokenizer (PreTrainedTokenizer): The tokenizer.
+       prompts (List[str]): The string prompts.
+       temp (float): The temperature for sampling (default 0).
+       max_tokens (int): The maximum number of tokens per prompt (default 100).
+       verbose (bool): If ``True``, print timing information
+           (default ``False``).
+       top_p (float): Nucleus sampling threshold, disabled at 1.0.
+       top_k (int): Only sample from the `top_k` most likely tokens,
+           disabled at 0.
+       min_p (float): Only sample tokens at least `min_p` times as likely as
+           the most likely one, disabled at 0.0.
+       batch_size (int): Maximum number of prompts decoded together.
+       kv_bits (int, optional): Quantize the KV cache to this many bits.
+    """
+    prompt_tokens = [mx.array(tokenizer.encode(prompt)) for prompt in prompts]
+    order = sorted(range(len(prompts)), key=lambda i: prompt_tokens[i].size)
+    tokens = [[] for _ in prompts]
+
+    tic = time.perf_counter()
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        generator = batch_generate_step(
+            [prompt_tokens[i] for i in batch],
+            model,
+            tokenizer.eos_token_id,
+            max_tokens,
+            temp,
+            top_p,
+            top_k,
+            min_p,
+            kv_bits=kv_bits,
+        )
+        for rows, step in generator:
+            for row, token in zip(rows, step):
+                tokens[batch[row]].append(token)
+    gen_time = time.perf_counter() - tic
+
+    if verbose:
+        token_count = sum(len(t) for t in tokens)
+        prompt_count = sum(p.size for p in prompt_tokens)
+        print("=" * 10)
+        print(f"Prompts: {len(prompts)}, {prompt_count} tokens")
+        print(f"Generation: {token_count / gen_time:.3f} tokens-per-sec "
+              f"(including prefill)")
+
+    return [tokenizer.decode(t) for t in tokens]
+
+
+def get_peak_rss() -> int:
+    """
+    Peak resident set size in bytes over the whole life of the process, the
+    high-water mark of everything it did so far rather than of one step.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _read_ahead(path: str):
+    """
+    Ask the OS to read a weight file into the page cache in the background,
+    so the file is read while the arrays before it are materialized.
+    """
+    if not hasattr(mmap, "MADV_WILLNEED"):
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        m.madvise(mmap.MADV_WILLNEED)
+
+
+def load_model(
+    model_path: Path,
+    lazy: bool = False,
+    fuse: bool = False,
+    model_config: dict = {},
+    read_ahead: bool = True,
+) -> nn.Module:
     """
     Load and initialize the model from a given path.
 
@@ -288,6 +1060,14 @@ def load_model(model_path: Path, lazy: bool = False) -> nn.Module:
         lazy (bool): If False eval the model parameters to make sure they are
             loaded in memory before returning, otherwise they will be loaded
             when needed. Default: ``False``
+        fuse (bool): If True fuse the projections sharing an input into
+            single (quantized) linears for inference. The fused model can
+            no longer be saved in the original format. Default: ``False``
+        model_config (dict, optional): Configuration parameters overriding
+            the model's config, e.g. ``attention_block_size`` to attend in
+            blocks of keys. Defaults to an empty dictionary.
+        read_ahead (bool): If True memory map the weight files and have the
+            OS read them ahead of their materialization. Default: ``True``
 
     Returns:
         nn.Module: The loaded and initialized model.
@@ -300,6 +1080,7 @@ def load_model(model_path: Path, lazy: bool = False) -> nn.Module:
         with open(model_path / "config.json", "r") as f:
             config = json.load(f)
             quantization = config.get("quantization", None)
+        config.update(model_config)
     except FileNotFoundError:
         logging.error(f"Config file not found in {model_path}")
         raise
@@ -309,6 +1090,8 @@ def load_model(model_path: Path, lazy: bool = False) -> nn.Module:
         logging.error(f"No safetensors found in {model_path}")
         raise FileNotFoundError(f"No safetensors found in {model_path}")
 
+    tic = time.perf_counter()
+    # the loaded arrays are lazy, the files are only read when they are evaluated
     weights = {}
     for wf in weight_files:
         weights.update(mx.load(wf))
@@ -342,9 +1125,27 @@ def load_model(model_path: Path, lazy: bool = False) -> nn.Module:
             )
 
     model.load_weights(list(weights.items()))
+    # the model holds the only references left, so arrays replaced by
+    # `fuse` are freed once their replacement is evaluated
+    del weights
+
+    if fuse and hasattr(model, "fuse"):
+        model.fuse()
 
     if not lazy:
+        if read_ahead:
+            for wf in weight_files:
+                _read_ahead(wf)
+        # one layer at a time, so the transient copies of `fuse` never
+        # exceed a layer
+        for layer in getattr(model, "layers", []):
+            mx.eval(layer.parameters())
         mx.eval(model.parameters())
+        print(
+            f"[INFO] Loaded {model_path} in {time.perf_counter() - tic:.2f}s, "
+            f"process peak RSS {get_peak_rss() / 2**30:.2f} GB",
+            flush=True,
+        )
 
     model.eval()
     return model
@@ -355,6 +1156,8 @@ def load(
     tokenizer_config={},
     adapter_file: str = None,
     lazy: bool = False,
+    fuse: bool = False,
+    model_config: dict = {},
 ) -> Tuple[nn.Module, PreTrainedTokenizer]:
     """
     Load the model and tokenizer from a given path or a huggingface repository.
@@ -368,6 +1171,10 @@ def load(
         lazy (bool): If False eval the model parameters to make sure they are
             loaded in memory before returning, otherwise they will be loaded
             when needed. Default: ``False``
+        fuse (bool): If True fuse the projections sharing an input for
+            inference. Default: ``False``
+        model_config (dict, optional): Configuration parameters overriding
+            the model's config. Defaults to an empty dictionary.
     Returns:
         Tuple[nn.Module, PreTrainedTokenizer]: A tuple containing the loaded model and tokenizer.
 
@@ -377,7 +1184,7 @@ def load(
     """
     model_path = get_model_path(path_or_hf_repo)
 
-    model = load_model(model_path, lazy)
+    model = load_model(model_path, lazy, fuse, model_config)
     if adapter_file is not None:
         # TODO: Apply LoRA layers
         # model = apply_lora_layers(model, adapter_file)